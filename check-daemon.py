@@ -0,0 +1,257 @@
+#!/bin/python
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import check
+import checks
+import util.cargo
+import util.remote
+import util.toolchain
+from util import colors, log, profile
+from util.git import git_common_dir, merge_bases, rev_parse
+from util.notes import notes_index
+from util.scheduler import Scheduler
+
+# How many finished requests `status` remembers
+HISTORY = 50
+
+def socket_path() -> str:
+    return os.path.join(git_common_dir(), 'check-daemon.sock')
+
+class Request:
+    """One check.py run: the commits on `tip` which are not on `master`, resolved when submitted"""
+    def __init__(self, id: int, tip: str, master: str, checks_json: str, one: bool, bisect: bool, commits: List[str], skip: Set[str]):
+        self.id: int = id
+        self.tip: str = tip
+        self.master: str = master
+        self.checks_json: str = checks_json
+        self.one: bool = one
+        self.bisect: bool = bisect
+        self.commits: List[str] = commits
+        # Commits which an earlier queued or running request is already checking the same way
+        self.skip: Set[str] = skip
+        self.state: str = 'queued'
+        self.submitted: float = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.done = threading.Event()
+
+    def key(self) -> Tuple[str, str, str, bool, bool]:
+        return (self.tip, self.master, self.checks_json, self.one, self.bisect)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'tip': self.tip,
+            'master': self.master,
+            'commits': len(self.commits),
+            'skipped': len(self.skip),
+            'state': self.state,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+class Daemon:
+    """
+    Runs check.py requests one after another on a long-lived scheduler
+
+    Worktrees, resolved toolchain versions and the notes index stay warm
+    between requests; the index is refreshed as each request starts.
+
+    A request identical to one already queued or running is answered with
+    that request. Otherwise any of its commits which a queued or running
+    request is already checking with the same checks are left to that one.
+    """
+    def __init__(self, scheduler: Scheduler):
+        self.scheduler = scheduler
+        self.cond = threading.Condition()
+        self.queue: Deque[Request] = collections.deque()
+        self.requests: List[Request] = []
+        self.ids = itertools.count(1)
+        self.stopping = False
+
+    def submit(self, tip: str, master: str, checks_json: str, one: bool, bisect: bool) -> Request:
+        # Fail now, rather than when the request is run, if the checks do not parse
+        json.loads(checks_json, object_hook=checks.json_object_hook)
+        checks_json = json.dumps(json.loads(checks_json), sort_keys=True)
+        tip = rev_parse(tip)
+        master = rev_parse(master)
+        commits = [tip] if one else merge_bases(master, [tip])[tip][1]
+        with self.cond:
+            pending = [request for request in self.requests if request.state in ('queued', 'running')]
+            for request in pending:
+                if request.key() == (tip, master, checks_json, one, bisect):
+                    log(f"Request {request.id} already covers {tip}")
+                    return request
+            # Bisecting checks only some of a request's commits, so those cover nothing
+            covered = {commit for request in pending if request.checks_json == checks_json and not request.bisect for commit in request.commits if commit not in request.skip}
+            skip = covered.intersection(commits)
+            request = Request(next(self.ids), tip, master, checks_json, one, bisect, commits, skip)
+            log(f"{colors.magenta('Queued')} request {request.id}: {colors.bold(tip)}" + (f", {len(skip)} of {len(commits)} commits already being checked" if skip else ""))
+            self.requests.append(request)
+            self.queue.append(request)
+            self.cond.notify_all()
+            return request
+
+    def status(self) -> Dict[str, Any]:
+        with self.cond:
+            return { 'requests': [request.to_json() for request in self.requests] }
+
+    def stop(self) -> None:
+        with self.cond:
+            self.stopping = True
+            for request in self.queue:
+                request.state = 'cancelled'
+                request.done.set()
+            self.queue.clear()
+            self.cond.notify_all()
+
+    def work(self) -> None:
+        while True:
+            with self.cond:
+                while len(self.queue) == 0 and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                request = self.queue.popleft()
+                request.state = 'running'
+                request.started = time.time()
+
+            log(f"{colors.magenta('Running')} request {request.id}: {colors.bold(request.tip)}")
+            util.toolchain.forget()
+            # Pick up notes written since the last request by anything else, e.g. a plain check.py
+            notes_index('check-commit').refresh()
+            try:
+                failed = check.check_tip(self.scheduler, request.tip, request.master, request.checks_json, one=request.one, bisect=request.bisect, skip=request.skip)
+            except Exception as e:
+                log(f"Request {request.id} failed: {e}")
+                failed = True
+            finally:
+                if util.cargo.target_cache is not None:
+                    util.cargo.target_cache.cleanup()
+            profile.summary(self.scheduler.submitted)
+            profile.reset()
+            self.scheduler.forget_done()
+
+            with self.cond:
+                request.state = 'failed' if failed else 'passed'
+                request.finished = time.time()
+                request.done.set()
+                finished = [r for r in self.requests if r.done.is_set()]
+                for r in finished[:max(0, len(finished) - HISTORY)]:
+                    self.requests.remove(r)
+
+    def handle(self, conn: socket.socket) -> None:
+        with conn, conn.makefile('rw') as f:
+            try:
+                msg = json.loads(f.readline())
+                if msg['op'] == 'submit':
+                    request = self.submit(msg['tip'], msg['master'], msg['checks'], msg.get('one', False), msg.get('bisect', False))
+                    if msg.get('wait', True):
+                        request.done.wait()
+                    reply = request.to_json()
+                elif msg['op'] == 'status':
+                    reply = self.status()
+                elif msg['op'] == 'stop':
+                    self.stop()
+                    reply = {}
+                else:
+                    reply = { 'error': f"unknown op {msg['op']}" }
+            except Exception as e:
+                reply = { 'error': str(e) }
+            f.write(json.dumps(reply) + "\n")
+
+    def serve(self, path: str) -> None:
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            try:
+                call({ 'op': 'status' }, path)
+                raise RuntimeError(f"A daemon is already listening on {path}")
+            except ConnectionRefusedError:
+                os.unlink(path) # left behind by a daemon which did not exit cleanly
+        server.bind(path)
+        server.listen()
+        server.settimeout(1)
+        log(f"Listening on {path}")
+
+        worker = threading.Thread(target=self.work, name="git_check_daemon")
+        worker.start()
+        try:
+            while not self.stopping:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            self.stop()
+            server.close()
+            os.unlink(path)
+            worker.join()
+
+def call(msg: Dict[str, Any], path: Optional[str] = None) -> Dict[str, Any]:
+    """Send one request to the daemon and return its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path or socket_path())
+        with conn.makefile('rw') as f:
+            f.write(json.dumps(msg) + "\n")
+            f.flush()
+            reply = json.loads(f.readline())
+    if 'error' in reply:
+        log(f"Daemon: {reply['error']}")
+        sys.exit(2)
+    return reply
+
+def main() -> None:
+    parser = argparse.ArgumentParser("Keeps check.py warm in the background and queues checks for it")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help="Run the daemon for the repository in the current directory")
+    check.add_config_arguments(serve)
+    check.add_remote_arguments(serve)
+
+    submit = commands.add_parser('submit', help="Queue checks of the commits on TIP (for instance from a post-receive hook, with --no-wait)")
+    submit.add_argument('tip')
+    submit.add_argument('checks', help="Checks, as JSON, as for check.py")
+    submit.add_argument('--master', default='master', help="Set the master branch that we should base work off of")
+    submit.add_argument('--one', action='store_true', help="Only check one commit rather than iterating")
+    submit.add_argument('--bisect', action='store_true', help="Binary-search for the first commit failing each check, as for check.py")
+    submit.add_argument('--no-wait', action='store_true', help="Return as soon as the checks are queued")
+
+    commands.add_parser('status', help="List queued, running and recently finished requests")
+    commands.add_parser('stop', help="Stop the daemon once the running request finishes; queued requests are dropped")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        check.configure(args)
+        check.configure_remote(args)
+        try:
+            with Scheduler(cores=args.cores, mem=args.mem, worktrees=args.worktrees, workers=util.remote.workers) as scheduler:
+                Daemon(scheduler).serve(socket_path())
+        finally:
+            util.remote.close()
+    elif args.command == 'submit':
+        reply = call({ 'op': 'submit', 'tip': args.tip, 'master': args.master, 'checks': args.checks, 'one': args.one, 'bisect': args.bisect, 'wait': not args.no_wait })
+        log(f"Request {reply['id']} for {colors.bold(reply['tip'])}: {reply['state']}")
+        if reply['state'] in ('failed', 'cancelled'):
+            sys.exit(1)
+    elif args.command == 'status':
+        for request in call({ 'op': 'status' })['requests']:
+            since = request['finished'] or request['started'] or request['submitted']
+            print(f"{request['id']:4d} {request['state']:9} {request['tip'][:12]} on {request['master'][:12]}  {time.time() - since:6.0f}s ago  {request['commits'] - request['skipped']}/{request['commits']} commits")
+    elif args.command == 'stop':
+        call({ 'op': 'stop' })
+
+if __name__ == '__main__':
+    main()
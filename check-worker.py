@@ -0,0 +1,36 @@
+#!/bin/python
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import check
+import checks
+import util.remote
+from util import log
+from util.scheduler import Scheduler
+
+def main() -> None:
+    parser = argparse.ArgumentParser("Runs checks shipped by check.py --workers/--worker-command; speaks JSON lines on stdin and stdout")
+    parser.add_argument('--repo', help="Repository to fetch commits into and check them out from (default: a new temporary one)")
+    check.add_config_arguments(parser)
+    args = parser.parse_args()
+    check.configure(args)
+
+    # Our stdout carries results; everything else, including what commands print, goes to stderr
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    with tempfile.TemporaryDirectory(prefix='git-check-worker-') as tempdir:
+        repo = args.repo or tempdir
+        if not os.path.exists(os.path.join(repo, '.git')):
+            subprocess.check_call(["git", "init", "-q", repo])
+        os.chdir(repo)
+        log(f"Worker ready in {repo}")
+        with Scheduler(cores=args.cores, mem=args.mem, worktrees=args.worktrees) as scheduler:
+            util.remote.serve(scheduler, checks.json_object_hook, sys.stdin, output)
+
+if __name__ == '__main__':
+    main()
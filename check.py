@@ -2,82 +2,389 @@
 
 import argparse
 from concurrent import futures
-import git # type: ignore
 import glob
 import json
 import os
-from typing import List, Optional, Tuple
+import shlex
+import subprocess
+from typing import AbstractSet, Callable, Dict, List, Optional, Set, Tuple, Union
 import sys
 
 import checks
-from util import colors, log
-from util.git import TemporaryWorkdir, cherry_pick, actual_merge_base
-from util.cargo import Cargo 
-from util.notes import attach_note, check_is_note
-
-def run_commit(executor: futures.ThreadPoolExecutor, commit: str, old_commit: Optional[str], commands: List[checks.Check], is_tip: bool) -> Tuple[List[str], str, Optional[str]]:
-    notes: List[str] = []
-    for command in commands:
-        if is_tip or not command.only_tip:
-            command.run(executor, commit, notes)
-    return notes, commit, old_commit
+from util import colors, log, profile
+from util.git import git_common_dir, is_ancestor, merge_bases, rebase_commit, rev_parse
+import util.cargo
+import util.history
+import util.notes
+import util.process
+import util.remote
+import util.results
+from util.cargo import Cargo, LockfileCache, TargetCache
+from util.history import History
+from util.notes import NotesBatch, check_is_note, timed_out
+from util.remote import CommandTransport, RemoteFailed, local_transport
+from util.results import ResultCache
+from util.scheduler import Job, Scheduler, total_mem
 
-def main() -> None:
-    ## Parse commands
-    parser = argparse.ArgumentParser("Runs checks on the current commit (in a /tmp workdir) and records them as git notes")
-    parser.add_argument('--master', default='master', help="Set the master branch that we should base work off of")
-    parser.add_argument('--one', action='store_true', help="Only check one commit rather than iterating")
-    args, unknown_args = parser.parse_known_args()
+def schedule_commit(scheduler: Scheduler, commit: str, old_commit: Optional[str], commands: List[checks.Check], is_tip: bool) -> Job:
+    """Submit every check of `commit`, and a job which collects their notes as (notes, commit, old_commit)"""
+    jobs: List[Job] = []
+    with scheduler.batch():
+        for command in commands:
+            if is_tip or not command.only_tip:
+                jobs += [scheduler.submit(job) for job in util.remote.make_jobs(command, commit)]
+
+    def collect(_job: Job) -> Tuple[List[str], str, Optional[str]]:
+        return [note for job in jobs for note in job.result()], commit, old_commit
+    return scheduler.submit(Job(f"notes for {commit}", collect, cores=0, deps=jobs))
+
+def schedule_rebase(scheduler: Scheduler, old_commit: str, onto: Union[str, Job], commands: List[checks.Check], is_tip: bool) -> Job:
+    """
+    Submit a job which rebases `old_commit` onto `onto`, then schedules the checks of the result
+
+    `onto` is a commit, or the rebase job of the previous commit in the
+    series. The job returns (rebased commit, collector job), so the checks
+    of each rebased commit start as soon as it exists.
+    """
+    def rebase(_job: Job) -> Tuple[str, Job]:
+        base = onto if isinstance(onto, str) else onto.result()[0]
+        commit = rebase_commit(old_commit, base)
+        return commit, schedule_commit(scheduler, commit, old_commit, commands, is_tip)
+    deps = [] if isinstance(onto, str) else [onto]
+    return scheduler.submit(Job(f"rebase {old_commit}", rebase, cores=0, deps=deps))
+
+class Bisection:
+    """
+    Binary search for the first commit of a series which fails one check
+
+    The tip and the base are checked first. If the tip passes, or the base
+    fails too, there is nothing to search for; otherwise each round checks
+    the commit halfway between the last one known to pass and the first
+    one known to fail. Index -1 is the base.
+    """
+    def __init__(self, command: checks.Check, series: List[Tuple[str, Optional[str]]], base: str):
+        self.command = command
+        self.series = series
+        self.base = base
+        self.good: Optional[int] = None
+        self.bad: Optional[int] = None
+        self.tested: Set[int] = set()
+
+    def commit(self, i: int) -> Tuple[str, Optional[str]]:
+        return (self.base, None) if i == -1 else self.series[i]
+
+    def done(self) -> bool:
+        return len(self.tested) > 0 and (self.good is None or self.bad is None or self.bad - self.good <= 1)
+
+    def to_test(self) -> List[int]:
+        if len(self.tested) == 0:
+            return [len(self.series) - 1] + ([] if self.command.only_tip else [-1])
+        if self.done():
+            return []
+        assert self.good is not None and self.bad is not None
+        return [(self.good + self.bad) // 2]
+
+    def update(self, i: int, passed: bool) -> None:
+        self.tested.add(i)
+        if passed:
+            self.good = i if self.good is None else max(self.good, i)
+        else:
+            self.bad = i if self.bad is None else min(self.bad, i)
+
+    def skipped(self) -> List[int]:
+        if self.command.only_tip:
+            return []
+        return [i for i in range(len(self.series)) if i not in self.tested]
+
+def bisect(scheduler: Scheduler, bisections: List[Bisection]) -> Tuple[Dict[Tuple[str, Optional[str]], List[str]], bool]:
+    """
+    Run `bisections` side by side, a round at a time
+
+    Returns the notes to attach, by (commit, old_commit), and whether any
+    check failed.
+    """
+    notes: Dict[Tuple[str, Optional[str]], List[str]] = {}
+    failed = False
+    while True:
+        with scheduler.batch():
+            round = [(b, i, [scheduler.submit(job) for job in util.remote.make_jobs(b.command, b.commit(i)[0])]) for b in bisections for i in b.to_test()]
+        if len(round) == 0:
+            break
+        for b, i, jobs in round:
+            passed = True
+            for job in jobs:
+                try:
+                    job_notes = job.result()
+                except Exception as e:
+                    log(f"{colors.bold(job.name)}: {e}")
+                    passed = False
+                    continue
+                notes.setdefault(b.commit(i), []).extend(job_notes)
+                passed &= not timed_out(job_notes)
+            failed |= not passed
+            b.update(i, passed)
+
+    for b in bisections:
+        if b.bad == -1:
+            log(f"{b.command.TYPE} checks already fail on {b.base}")
+        elif b.bad is not None:
+            log(f"First commit failing {b.command.TYPE} checks is {colors.bold(b.commit(b.bad)[0])}")
+        for i in b.skipped():
+            line = f"not checked, bisected: {b.command.TYPE}"
+            if line not in notes.get(b.commit(i), []) and not check_is_note(line, '.', commit=b.commit(i)[0], note_ref='check-commit'):
+                notes.setdefault(b.commit(i), []).append(line)
+    return notes, failed
+
+def finished_notes(job: Job) -> List[str]:
+    """The notes of `job` if it finished, or of the jobs which finished in a unit which failed on a worker"""
+    if not job.done() or job.future.cancelled():
+        return []
+    e = job.future.exception()
+    return job.result() if e is None else e.notes if isinstance(e, RemoteFailed) else []
+
+def check_commits(scheduler: Scheduler, commit_list: List[str], rebase: bool, master: str, commands: List[checks.Check], attach: Callable[[List[str], str, Optional[str]], None], skip: AbstractSet[str] = frozenset()) -> bool:
+    """Check every commit not in `skip`, and if `rebase` every commit rebased onto `master`; returns whether any check failed"""
+    commit_jobs: List[Tuple[Job, str]] = []
+    rebase_jobs = []
+
+    # Everything is submitted before anything starts, so the longest checks of any commit go first
+    with scheduler.batch():
+        ## Iterate over all commits in-place
+        for n, commit in enumerate(commit_list, start=1):
+            if commit not in skip:
+                commit_jobs.append((schedule_commit(scheduler, commit, None, commands, n == len(commit_list)), commit))
+
+        ## If not already based on master, rebase each PR commit onto it in memory and check that too
+        if rebase:
+            onto: Union[str, Job] = master
+            for n, commit in enumerate(commit_list, start=1):
+                onto = schedule_rebase(scheduler, commit, onto, commands, n == len(commit_list))
+                rebase_jobs.append(onto)
+
+    ## Get results; notes are written together as a single notes commit
+    failed = False
+    collected: List[Tuple[Job, Optional[str], Optional[str]]] = [(job, commit, None) for job, commit in commit_jobs]
+    collected += [(job, None, commit) for job, commit in zip(rebase_jobs, commit_list)]
+    for commit_job, commit, old_commit in collected:
+        collector = commit_job
+        try:
+            if commit is None:
+                commit, collector = commit_job.result()
+            notes, _, _ = collector.result()
+        except Exception as e: # including futures.CancelledError
+            log(f"{colors.bold(collector.name)}: {'cancelled' if isinstance(e, futures.CancelledError) else e}")
+            failed = True
+            if commit is not None:
+                # Keep what the checks which did finish found, e.g. that a command timed out
+                attach([note for job in collector.deps for note in finished_notes(job)], commit, old_commit)
+            continue
+        log(f"Completed {colors.bold(str(commit))}. Notes {len(notes)}")
+        if timed_out(notes):
+            log(f"{colors.bold(commit_job.name)}: some checks timed out")
+            failed = True
+        attach(notes, commit, old_commit)
+    return failed
+
+def bisect_commits(scheduler: Scheduler, commit_list: List[str], base: str, rebase: bool, master: str, commands: List[checks.Check], attach: Callable[[List[str], str, Optional[str]], None]) -> bool:
+    """Bisect every check over the commits, and if `rebase` over them rebased onto `master`; returns whether any check failed"""
+    series: List[Tuple[str, Optional[str]]] = [(commit, None) for commit in commit_list]
+    bisections = [Bisection(command, series, base) for command in commands]
+    failed = False
+    if rebase:
+        try:
+            rebased = []
+            onto = master
+            for commit in commit_list:
+                onto = rebase_commit(commit, onto)
+                rebased.append((onto, commit))
+            bisections += [Bisection(command, rebased, master) for command in commands]
+        except subprocess.CalledProcessError as e:
+            log(f"Could not rebase onto {master}: {e}")
+            failed = True
 
+    notes, bisect_failed = bisect(scheduler, bisections)
+    for (commit, old_commit), lines in notes.items():
+        attach(lines, commit, old_commit)
+    return failed or bisect_failed
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    """Arguments which configure how checks run, rather than what is checked"""
+    parser.add_argument('--cores', type=int, help="Number of cores jobs may use between them (default: all of them)")
+    parser.add_argument('--mem', type=int, help="Memory in MiB jobs may use between them (default: 80%% of physical memory)")
+    parser.add_argument('--worktrees', type=int, help="Number of worktrees to check out at once (default: one per core)")
+    parser.add_argument('--target-cache-size', type=float, default=20, help="Size in GiB of the cargo target directories shared between commits and worktrees; 0 to disable (default: 20)")
+    parser.add_argument('--lockfile-max-age', type=float, default=24, help="Hours for which a resolved Cargo.lock is reused for identical manifests; 0 to resolve every time (default: 24)")
+    parser.add_argument('--offline', action='store_true', help="Never use the network: reuse cached lockfiles regardless of age, and run cargo with CARGO_NET_OFFLINE")
+    parser.add_argument('--log-dir', help="Directory for per-command output logs (default: a new directory under ~/.cache/git-scripts/logs)")
+    parser.add_argument('--compress-logs', action='store_true', help="gzip command logs as they are written")
+    parser.add_argument('--follow', metavar='REGEX', help="Echo the output of commands matching REGEX as it arrives")
+    parser.add_argument('--note-durations', action='store_true', help="Record how long each command took in its note line")
+    parser.add_argument('--no-result-cache', action='store_true', help="Run every check, even if an identical tree has already passed it")
+    parser.add_argument('--no-history', action='store_true', help="Do not record checks in the history database (see history.py)")
+
+def add_remote_arguments(parser: argparse.ArgumentParser) -> None:
+    """Arguments which ship checks to workers rather than running them here"""
+    parser.add_argument('--workers', type=int, help="Run checks on this many check-worker.py processes on this machine, as a stand-in for remote workers")
+    parser.add_argument('--worker-command', action='append', metavar='CMD', help="Run checks on a worker started by CMD, e.g. 'ssh builder ./check-worker.py'; may be repeated")
+    parser.add_argument('--remote', help="Git remote workers fetch commits from; commits are pushed there under refs/git-check/ (default: this repository)")
+
+def worker_count(args: argparse.Namespace) -> int:
+    """How many workers checks are shipped to, if any"""
+    return len(args.worker_command) if args.worker_command is not None else args.workers or 0
+
+def configure_remote(args: argparse.Namespace) -> None:
+    """Start the workers, if there are to be any"""
+    util.remote.workers = worker_count(args)
+    if util.remote.workers == 0:
+        return
+    util.remote.remote = args.remote or os.path.abspath(git_common_dir())
+    if args.worker_command is not None:
+        util.remote.transport = CommandTransport([shlex.split(command) for command in args.worker_command])
+    else:
+        # The workers share this machine's cores and memory, and everything else is as configured here
+        cores = max(1, (args.cores or os.cpu_count() or 1) // args.workers)
+        mem = max(1, (args.mem or total_mem() * 4 // 5) // args.workers)
+        util.remote.transport = local_transport(args.workers, config_argv(args, cores=cores, mem=mem))
+
+def config_argv(args: argparse.Namespace, **overrides) -> List[str]:
+    """The options of `add_config_arguments` which would parse to `args`, with `overrides`, to pass on to a worker"""
+    parser = argparse.ArgumentParser(add_help=False)
+    add_config_arguments(parser)
+    argv: List[str] = []
+    for action in parser._actions:
+        value = overrides.get(action.dest, getattr(args, action.dest))
+        if value is None or value is False:
+            continue
+        elif value is True:
+            argv.append(action.option_strings[0])
+        else:
+            argv += [action.option_strings[0], str(value)]
+    return argv
+
+def configure(args: argparse.Namespace) -> None:
+    if args.target_cache_size > 0:
+        util.cargo.target_cache = TargetCache(int(args.target_cache_size * (1 << 30)))
+    if args.lockfile_max_age > 0 or args.offline:
+        util.cargo.lockfile_cache = LockfileCache(args.lockfile_max_age * 3600)
+    util.cargo.offline = args.offline
+    util.process.log_dir = args.log_dir
+    util.process.compress_logs = args.compress_logs
+    util.process.follow = args.follow
+    util.notes.note_durations = args.note_durations
+    if not args.no_result_cache:
+        util.results.result_cache = ResultCache()
+    if not args.no_history:
+        util.history.history = History()
+
+def needs_rebase(tip: str, base: str, master: str) -> bool:
+    """Whether the commits of `tip` should also be checked rebased onto `master`: not if they are on it already"""
+    return master != base and not is_ancestor(rev_parse(tip), master)
+
+def check_tip(scheduler: Scheduler, tip: str, master_ref: str, checks_json: str, one: bool = False, bisect: bool = False, skip: AbstractSet[str] = frozenset()) -> bool:
+    """
+    Check the commits on `tip` which are not on `master_ref`, and note the results; returns whether any check failed
+
+    Unless bisecting, commits in `skip` are left to whoever else is checking
+    them, though they are still rebased so that the commits after them can be.
+    """
     ## Determine whether we were already based on master
-    master = git.Git().rev_parse(args.master)
+    master = rev_parse(master_ref)
 
     ## Get commits which are on the provided ref but not on master
-    tip = unknown_args[0]
-    base = actual_merge_base(args.master, tip)
-    commit_list = [x for x in git.Repo().iter_commits(f"{base}..{tip}")]
-    commit_list.reverse()
+    base, commit_list = merge_bases(master, [tip])[tip]
+    rebase = needs_rebase(tip, base, master)
 
-    commands: List[checks.Check] = json.loads(unknown_args[1], object_hook=checks.json_object_hook)
+    commands: List[checks.Check] = json.loads(checks_json, object_hook=checks.json_object_hook)
 
-    if args.one:
+    if one:
         log ("Only checking the one commit " + tip)
-        commit_list = [tip]
+        commit_list = [rev_parse(tip)]
     else:
         log ("Master is " + master)
-        log ("Merge base is " + str(base))
+        log ("Merge base is " + base)
 
-    ## Start thread pool
-    executor = futures.ThreadPoolExecutor(thread_name_prefix='git_check')
-    futs = []
+    batch = NotesBatch("check-commit")
+    def attach(notes: List[str], commit: str, old_commit: Optional[str]) -> None:
+        if notes:
+            batch.append("\n".join(notes), commit=commit)
+            if old_commit:
+                notes = [f"rebased for merge-testing on {master} as {commit}"] + notes
+                batch.append("\n".join(notes), commit=old_commit)
 
-    ## Iterate over all commits in-place
-    for commit in commit_list:
-        futs.append(executor.submit(lambda: run_commit(executor, commit, None, commands, commit == commit_list[-1])))
+    try:
+        if bisect:
+            return bisect_commits(scheduler, commit_list, base, rebase, master, commands, attach)
+        else:
+            return check_commits(scheduler, commit_list, rebase, master, commands, attach, skip)
+    finally:
+        batch.flush()
 
-    ## If not already based on master, rebase and check each PR
-    if master != base.hexsha:
-        rebased_commit_list = []
-        with TemporaryWorkdir(base.hexsha) as workdir:
-            for commit in commit_list:
-                rebased_commit_list.append((commit, cherry_pick(workdir, commit)))
+def plan_tip(scheduler: Scheduler, tip: str, master_ref: str, checks_json: str, one: bool = False) -> None:
+    """Print the order check_tip would start its jobs in, by how long they took before, and when it would be done"""
+    master = rev_parse(master_ref)
+    base, commit_list = merge_bases(master, [tip])[tip]
+    if one:
+        commit_list = [rev_parse(tip)]
+    commands: List[checks.Check] = json.loads(checks_json, object_hook=checks.json_object_hook)
 
-        for old_commit, commit in rebased_commit_list:
-            futs.append(executor.submit(lambda: run_commit(executor, commit, old_commit, commands, commit == rebased_commit_list[-1])))
+    jobs: List[Job] = []
+    for rebased in [False, True] if needs_rebase(tip, base, master) else [False]:
+        for n, commit in enumerate(commit_list, start=1):
+            for command in commands:
+                if n == len(commit_list) or not command.only_tip:
+                    for job in util.remote.make_jobs(command, commit):
+                        if rebased:
+                            job.name += f" (rebased onto {master[:12]})"
+                        jobs.append(job)
 
-    ## Get results
-    for fut in futs:
-        notes, commit, old_commit = fut.result()
-        log(f"Completed {colors.bold(str(commit))}. Notes {len(notes)}")
-        ## Attach notes, if any
-        if notes:
-            attach_note("\n".join(notes), note_ref="check-commit", commit=commit)
-            if old_commit:
-                notes = [f"rebased for merge-testing on {base} as {commit}"] + notes
-                attach_note("\n".join(notes), note_ref="check-commit", commit=old_commit)
+    plan = scheduler.plan(jobs)
+    print(colors.bold(f"Plan for {len(jobs)} jobs on {scheduler.cores} cores" + (f" and {scheduler.workers} workers:" if scheduler.workers > 0 else ":")))
+    for job, start, end in plan:
+        known = util.history.history is not None and util.history.history.job_duration(job.key) is not None
+        print(f"  {start:8.0f}s {end:8.0f}s {end - start:7.0f}s{' ' if known else '?'} {job.name}")
+    makespan = max((end for _, _, end in plan), default=0.0)
+    print(colors.bold(f"Estimated to take {makespan:.0f}s") + " (? marks jobs without history, guessed at their default)")
+
+def main() -> None:
+    ## Parse commands
+    parser = argparse.ArgumentParser("Runs checks on the current commit (in a /tmp workdir) and records them as git notes")
+    parser.add_argument('--master', default='master', help="Set the master branch that we should base work off of")
+    parser.add_argument('--one', action='store_true', help="Only check one commit rather than iterating")
+    parser.add_argument('--report', metavar='FILE', help="Write per-command timings and the critical path to FILE as JSON")
+    parser.add_argument('--plan', action='store_true', help="Only print the order jobs would start in and how long they would take, going by earlier runs")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--fail-fast', action='store_true', help="Stop starting new checks once one has failed")
+    mode.add_argument('--bisect', action='store_true', help="Check the tip and the base, then binary-search for the first commit failing each check; other commits are noted as not checked")
+    add_config_arguments(parser)
+    add_remote_arguments(parser)
+    args, unknown_args = parser.parse_known_args()
+    configure(args)
+
+    if args.plan:
+        # The workers are counted, but not started
+        util.remote.workers = worker_count(args)
+        plan_tip(Scheduler(cores=args.cores, mem=args.mem, worktrees=args.worktrees, workers=util.remote.workers), unknown_args[0], args.master, unknown_args[1], one=args.one)
+        return
+    configure_remote(args)
+
+    ## Start scheduler, which owns a pool of worktrees
+    with Scheduler(cores=args.cores, mem=args.mem, worktrees=args.worktrees, workers=util.remote.workers, fail_fast=args.fail_fast) as scheduler:
+        try:
+            failed = check_tip(scheduler, unknown_args[0], args.master, unknown_args[1], one=args.one, bisect=args.bisect)
+        finally:
+            util.remote.close()
+            if util.cargo.target_cache is not None:
+                util.cargo.target_cache.cleanup()
+
+    ## Report where the time went
+    profile.summary(scheduler.submitted)
+    if args.report is not None:
+        profile.write_report(args.report, scheduler.submitted)
 
     ## Ring bell to highlight workspace
     print("\a")
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,24 +1,70 @@
 #!/bin/python
 
-from concurrent import futures
-from typing import List
+import importlib
+from typing import Dict, List, Optional
+
+from util.process import Limits
+from util.scheduler import Job
+
+# Where each check type is defined, as 'module:class'; modules are only imported once a check of their type is used
+REGISTRY: Dict[str, str] = {
+    'autotools': 'checks.autotools:AutoToolsCheck',
+    'rust': 'checks.rust:RustChecks',
+    'wasm-pack': 'checks.wasm_pack:WasmPackCheck',
+}
+# Entry point group under which other packages can provide further check types, named by type
+ENTRY_POINTS = 'git_scripts.checks'
+
+_classes: Dict[str, type] = {}
+
+def check_class(type_: str) -> type:
+    """The Check subclass implementing `type_`, importing it if need be"""
+    if type_ in _classes:
+        return _classes[type_]
+    if type_ in REGISTRY:
+        module, name = REGISTRY[type_].split(':')
+        cls = getattr(importlib.import_module(module), name)
+    else:
+        # Only now pay for scanning installed packages
+        from importlib import metadata
+        entry_points = [ep for ep in metadata.entry_points(group=ENTRY_POINTS) if ep.name == type_]
+        if len(entry_points) == 0:
+            raise KeyError(f"test type {type_} did not match any known types")
+        cls = entry_points[0].load()
+    _classes[type_] = cls
+    return cls
 
 def json_object_hook(dct):
     if 'type' not in dct:
         raise KeyError('test commands must have the "type" field')
-
-    for cls in Check.__subclasses__():
-        if dct['type'] == cls.TYPE:
-            return cls(dct)
-
-    raise KeyError(f"test type {dct['type']} did not match any known types")
+    return check_class(dct['type'])(dct)
 
 class Check:
+    # What a single job of this check costs by default; see util.scheduler.Job
+    CORES = 1
+    MEM = 1024
+    # Seconds a command may take, and may go without output, before it is killed; None for no limit
+    TIMEOUT: Optional[float] = None
+    STALL_TIMEOUT: Optional[float] = None
+
     def __init__(self, json):
+        # As given, so the check can be shipped to a worker (see util.remote)
+        self.json = json
         self.only_tip = json.get('only-tip', False)
+        self.cores: int = json.get('cores', self.CORES)
+        self.mem: int = json.get('mem', self.MEM)
 
-    def run(self, executor: futures.ThreadPoolExecutor, commit: str, notes: List[str]):
-        raise NotImplementedError()
+    def limits(self, command: str) -> Limits:
+        """
+        The limits of one kind of command, e.g. 'test'
 
-from checks import autotools,rust,wasm_pack
+        "<command>-timeout" overrides "timeout"; "stall-timeout" is how long
+        any command may go without printing anything.
+        """
+        timeout = self.json.get(f'{command}-timeout', self.json.get('timeout', self.TIMEOUT))
+        return Limits(timeout, self.json.get('stall-timeout', self.STALL_TIMEOUT))
+
+    def make_jobs(self, commit: str) -> List[Job]:
+        """The jobs which check `commit`; each one returns the note lines it earned"""
+        raise NotImplementedError()
 
@@ -1,59 +1,181 @@
 #!/bin/python
 
+import hashlib
+import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 from concurrent import futures
-from typing import Any, Dict, List, MutableMapping, Optional
+from typing import Any, Dict, List, MutableMapping, Optional, Tuple
 
+import util.history
+import util.results
 from checks import Check
 from util import log
 from util.cargo import Cargo, Command
-from util.git import TemporaryWorkdir 
-from util.notes import check_is_note 
+from util.notes import annotate, check_is_note 
+from util.process import CommandTimedOut, run_logged
+from util.scheduler import Job
+
+class SourceTree:
+    """
+    One commit's sources, with autogen.sh already run, which builds share out of tree
+
+    The autogen job creates it, and it is removed once every job which
+    `use`s it is done, whether the job ran, failed or was cancelled.
+    """
+    def __init__(self, commit: str):
+        self.commit: str = commit
+        self.users: int = 0
+        self.root: Optional[str] = None
+        self.lock = threading.Lock()
+
+    @property
+    def src(self) -> str:
+        assert self.root is not None
+        return os.path.join(self.root, 'src')
+
+    def create(self) -> None:
+        with self.lock:
+            self.root = tempfile.mkdtemp(prefix='git-check-autotools-')
+
+    def use(self, job: Job) -> Job:
+        """Keep the tree until `job` is done"""
+        with self.lock:
+            self.users += 1
+        job.future.add_done_callback(lambda _: self.release())
+        return job
+
+    def build_dir(self, n: int) -> str:
+        assert self.root is not None
+        path = os.path.join(self.root, 'build', str(n))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def config_cache(self, config: List[str]) -> str:
+        """The config.cache configurations with the same compiler and flags share"""
+        precious = [arg for arg in config if not arg.startswith('-')]
+        assert self.root is not None
+        return os.path.join(self.root, 'config-' + hashlib.sha256(' '.join(precious).encode('utf-8')).hexdigest()[:16] + '.cache')
+
+    def release(self) -> None:
+        with self.lock:
+            self.users -= 1
+            if self.users == 0 and self.root is not None:
+                shutil.rmtree(self.root, ignore_errors=True)
 
 class AutoToolsCheck(Check):
     TYPE = 'autotools'
+    CORES = 8 # make -j8
 
     def __init__(self, json):
         self.run_bins: List[str] = json.get('run-bins', [])
         self.configure_matrix: List[List[str]] = json.get('configure-matrix', [[]])
+        # Share config.cache between configurations with the same compiler and flags
+        self.config_cache: bool = json.get('config-cache', True)
+        self.ccache: bool = json.get('ccache', False)
         super().__init__(json)
 
     def notes_str(self, config):
+        # Unchanged since builds went out of tree, so earlier notes still count
         return "./autogen.sh && ./configure " + ' '.join(config) + " && make -j8; " + " && ".join(self.run_bins)
 
-    def run_cmd(self, cmd: List[str], workdir: str):
+    def run_cmd(self, cmd: List[str], workdir: str, env: Optional[Dict[str, str]] = None, step: str = 'run'):
+        """Run one step of the build: 'autogen', 'configure', 'make' or 'run' (a binary); see Check.limits"""
         log (' '.join(cmd))
-        completed = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=workdir)
-        if completed.returncode != 0:
-            log ("Command failed: " + ' '.join(cmd))
-            log (completed.stderr.decode("ascii"))
-            completed.check_returncode() # trigger an exception
-
-    def real_run(self, executor, config: List[str], commit: str, note: str):
-        with TemporaryWorkdir(commit) as workdir:
-            self.run_cmd(["./autogen.sh"], workdir)
-            self.run_cmd(["./configure"] + config, workdir)
-            self.run_cmd(["make", "-j8"], workdir)
-
-            futs = []
-            for bin in self.run_bins:
-                futs.append(executor.submit(lambda: self.run_cmd(bin.split(' '), workdir)))
+        run_logged(cmd, cwd=workdir, env=env, kind='autotools', limits=self.limits(step))
+
+    def autogen(self, tree: SourceTree) -> List[str]:
+        """Create the tree, check out the commit's sources in it (without a worktree) and run autogen.sh in them"""
+        tree.create()
+        assert tree.root is not None
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tree.root, 'index'))
+        subprocess.check_call(["git", "read-tree", tree.commit], env=env)
+        subprocess.check_call(["git", "checkout-index", "-a", "-f", f"--prefix={tree.src}/"], env=env)
+        self.run_cmd(["./autogen.sh"], tree.src, step='autogen')
+        return []
+
+    def compiler_env(self, tree: SourceTree, config: List[str]) -> Tuple[List[str], Dict[str, str]]:
+        """Put ccache in front of the compiler, if we are asked to and have it"""
+        env = os.environ.copy()
+        if not self.ccache:
+            return config, env
+        if shutil.which('ccache') is None:
+            log ("ccache not found; building without it")
+            return config, env
+        # Paths under the (per-commit) root are hashed relative to it, so commits share cache entries
+        assert tree.root is not None
+        env['CCACHE_BASEDIR'] = tree.root
+        env['CCACHE_NOHASHDIR'] = '1'
+        if any(arg.startswith('CC=') for arg in config):
+            return [f"CC=ccache {arg[3:]}" if arg.startswith('CC=') else arg for arg in config], env
+        env['CC'] = 'ccache ' + env.get('CC', 'cc')
+        return config, env
+
+    def real_run(self, job: Job, commit: str, tree: SourceTree, n: int, config: List[str], note: str) -> List[str]:
+        start = time.time()
+        try:
+            self.build(job, tree, n, config)
+        except CommandTimedOut as e:
+            util.history.record(commit, None, note, start, False, e.log_path)
+            return [f"{e.reason}: {note}"]
+        except Exception as e:
+            util.history.record(commit, None, note, start, False, getattr(e, 'log_path', None))
+            raise
+        util.history.record(commit, None, note, start, True)
+        if util.results.result_cache is not None:
+            util.results.result_cache.put(commit, None, note)
+        return [annotate(note, time.time() - start)]
+
+    def build(self, job: Job, tree: SourceTree, n: int, config: List[str]) -> None:
+        """Configure, build and run the binaries of one configuration, out of tree"""
+        workdir = tree.build_dir(n)
+        config, env = self.compiler_env(tree, config)
+        if self.config_cache:
+            # Each configure gets a copy, and the last to succeed updates the shared one
+            shared = tree.config_cache(config)
+            with tree.lock:
+                if os.path.exists(shared):
+                    shutil.copyfile(shared, os.path.join(workdir, 'config.cache'))
+            config = config + ["--cache-file=config.cache"]
+        self.run_cmd([os.path.join(tree.src, "configure")] + config, workdir, env, step='configure')
+        if self.config_cache:
+            with tree.lock:
+                shutil.copyfile(os.path.join(workdir, 'config.cache'), shared + '.tmp')
+                os.replace(shared + '.tmp', shared)
+        self.run_cmd(["make", f"-j{job.cores}"], workdir, env, step='make')
+
+        # The binaries share this job's cores (and build directory) between them
+        with futures.ThreadPoolExecutor(max_workers=job.cores) as executor:
+            futs = [executor.submit(self.run_cmd, bin.split(' '), workdir, env) for bin in self.run_bins]
             for fut in futures.as_completed(futs):
-                pass
-        return note
+                fut.result()
 
-    def run(self, executor: futures.ThreadPoolExecutor, commit: str, notes: List[str]):
-        futs = []
+    def make_jobs(self, commit: str) -> List[Job]:
+        jobs = []
+        builds = []
         for config in self.configure_matrix:
             note = self.notes_str(config)
             if check_is_note(note, '.', commit=commit, note_ref='check-commit'):
                 log ("# already done " + note) # Note already inserted
+                continue
+            name = f"./configure {' '.join(config)} on {str(commit)[:12]}"
+            origin = util.results.result_cache.get(commit, None, note) if util.results.result_cache is not None else None
+            if origin is not None:
+                log (f"# cached from {origin} {note}")
+                line = note + f" [cached from {origin}]"
+                jobs.append(Job(name, lambda job, line=line: [line], cores=0))
             else:
-                futs.append(executor.submit(lambda: self.real_run(executor, config, commit, note)))
-
-        for fut in futures.as_completed(futs):
-            notes += [fut.result()]
-
-
-
+                builds.append((name, config, note))
+        if len(builds) == 0:
+            return jobs
 
+        # autogen.sh runs once, and every configuration builds out of tree from its output
+        tree = SourceTree(commit)
+        autogen = tree.use(Job(f"./autogen.sh on {str(commit)[:12]}", lambda job: self.autogen(tree), cores=1, mem=self.mem))
+        jobs.append(autogen)
+        for n, (name, config, note) in enumerate(builds):
+            jobs.append(tree.use(Job(name, lambda job, n=n, config=config, note=note: self.real_run(job, commit, tree, n, config, note), cores=self.cores, mem=self.mem, deps=[autogen])))
+        return jobs
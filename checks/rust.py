@@ -1,14 +1,36 @@
 #!/bin/python
 
 import glob
-import toml
+import hashlib
+import json as json_
+import re
 from concurrent import futures
-from typing import List, Optional
+from typing import Dict, List, Optional
 
+import util.results
 from checks import Check
-from util.cargo import Cargo, Command
-from util.git import TemporaryWorkdir 
-from util.notes import update_notes
+from util.cargo import Cargo, Command, ShardedTestCommand
+from util.fuzz import FuzzCorpus, corpus_key
+from util.git import repo_id
+from util.notes import check_is_note, update_notes
+from util.scheduler import Job
+from util.shards import TestDurations
+
+# Package ids of path dependencies include the worktree's path; fingerprints should not
+PATH_SOURCE = re.compile(r' \(path\+file://[^)]*\)|path\+file://[^#]*#')
+
+def fingerprint(artifacts: List[Dict]) -> str:
+    """Hash the set of units a cargo invocation compiled, by package, target, features and profile"""
+    units = set()
+    for artifact in artifacts:
+        units.add((
+            PATH_SOURCE.sub('', artifact['package_id']),
+            ' '.join(artifact['target']['kind']),
+            artifact['target']['name'],
+            ' '.join(sorted(artifact['features'])),
+            artifact['profile']['test'],
+        ))
+    return hashlib.sha256(repr(sorted(units)).encode('utf-8')).hexdigest()
 
 class RustChecks(Check):
     TYPE = 'rust'
@@ -25,16 +47,22 @@ class RustChecks(Check):
             if json.get('try_fuzz_target'):
                 self.checks = [RustCheck(version, json, fuzz_target=True, force_default_features=force_default_features)]
             self.checks = [RustCheck(version, json, force_default_features=force_default_features)]
+        self.prepass: bool = json.get('prepass', False)
+
+    def make_jobs(self, commit: str) -> List[Job]:
+        if not self.prepass:
+            return [job for check in self.checks for job in check.make_jobs(commit)]
 
-    def run(self, executor: futures.ThreadPoolExecutor, commit: str, notes: List[str]):
-        futs = []
-        for check in self.checks:
-            futs.append(executor.submit(lambda: check.run_(executor, commit)))
-        for fut in futures.as_completed(futs):
-            notes += fut.result()
+        # Type-check the whole feature x toolchain matrix first; if any of it
+        # fails, none of the real builds and tests are started. Entries which
+        # already have a result are left out, and if none are left, so is the prepass.
+        prepass = [job for job in (check.prepass_job(commit) for check in self.checks if check.jobs != ['fuzz']) if job is not None]
+        return prepass + [job for check in self.checks for job in check.make_jobs(commit, deps=prepass)]
 
 class RustCheck(Check):
     TYPE = None
+    CORES = 4
+    MEM = 2048
 
     def __init__(self, version, json, fuzz_target=False, force_default_features=False):
         super().__init__(json)
@@ -44,57 +72,150 @@ class RustCheck(Check):
         self.jobs: List[str] = json.get('jobs', ['build', 'test', 'examples'])
         self.fuzz_dir: str = json.get('fuzz_dir', 'fuzz/fuzz_targets')
         self.fuzz_iters: int = json.get('fuzz_iters', 1000000)
+        # Seconds to fuzz all targets for, between them; if unset, each runs for fuzz_iters iterations
+        self.fuzz_time: Optional[int] = json.get('fuzz_time')
         self.features: Optional[List[str]] = json.get('features')
         self.workdir_suffix: Optional[str] = json.get('working-dir')
+        # Spread the tests of each `cargo test` over the job's cores
+        self.shard_tests: bool = json.get('shard-tests', False)
+        # Compilation fingerprints found by the prepass, by commit, then job, then arguments
+        self.fingerprints: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+    def name(self, what: str, commit: str) -> str:
+        return f"cargo +{self.version} {what}{' (fuzz cfg)' if self.fuzz_target else ''} on {str(commit)[:12]}"
+
+    def make_jobs(self, commit: str, deps: List[Job] = []) -> List[Job]:
+        return [Job(self.name(' '.join(self.jobs), commit), lambda job: self.run_(job.workdir, commit, job.cores), cores=self.cores, mem=self.mem, worktree=commit, deps=deps)]
+
+    def prepass_job(self, commit: str) -> Optional[Job]:
+        pending = self.pending(commit)
+        if not any(pending.values()):
+            return None
+        return Job(self.name('check (prepass)', commit), lambda job: self.prepass(job.workdir, commit, job.cores, pending), cores=self.cores, mem=self.mem, worktree=commit)
+
+    def pending(self, commit: str) -> Dict[str, List[List[str]]]:
+        """The feature matrix entries of build and test which are neither noted on `commit` nor passed by an identical tree"""
+        # Only for note lines, so it needs no worktree
+        cargo = Cargo(version=self.version, cwd_suffix=self.workdir_suffix, fuzz_target=self.fuzz_target, force_default_features=self.force_default_features)
+        cache = util.results.result_cache
+        ret: Dict[str, List[List[str]]] = {}
+        for job in ('build', 'test'):
+            if job not in self.jobs:
+                continue
+            ret[job] = []
+            for args in self.matrix_args(cargo):
+                note = Command(job, cargo, args=args).notes_str()
+                if check_is_note(note, '.', commit=commit, note_ref='check-commit'):
+                    continue
+                if cache is not None and cache.get(commit, self.workdir_suffix, note) is not None:
+                    continue
+                ret[job].append(args)
+        return ret
+
+    def matrix_args(self, cargo: Cargo) -> List[List[str]]:
+        """Arguments for each entry of the feature matrix: default features, all features, each feature"""
+        ret: List[List[str]] = [[]]
+        if self.features is not None:
+            ret.append(cargo.feature_args(self.features))
+            if len(self.features) > 1:
+                ret += [cargo.feature_args([feature]) for feature in self.features]
+        return ret
+
+    def prepass(self, workdir: str, commit: str, cores: int, pending: Dict[str, List[List[str]]]) -> List[str]:
+        """
+        `cargo check` the `pending` entries of the feature matrix, recording a fingerprint of what each compiles
 
-    def run_(self, executor: futures.ThreadPoolExecutor, commit: str) -> List[str]:
+        Entries with the same fingerprint would build identical artifacts,
+        so `run_` only builds and tests one of them.
+        """
+        cargo = Cargo(cwd=workdir, cwd_suffix=self.workdir_suffix, version=self.version, fuzz_target=self.fuzz_target, force_default_features=self.force_default_features, jobs=cores, limits=self.limits)
+        fingerprints: Dict[str, Dict[str, str]] = {}
+        for job, extra_args in [('build', []), ('test', ['--tests'])]:
+            if job not in pending:
+                continue
+            fingerprints[job] = {}
+            for args in pending[job]:
+                artifacts: List[Dict] = []
+                def on_line(line: str) -> None:
+                    if line.startswith('{'):
+                        message = json_.loads(line)
+                        if message.get('reason') == 'compiler-artifact':
+                            artifacts.append(message)
+                Command("check", cargo, args=extra_args + args + ['--message-format=json']).run(on_line=on_line)
+                fingerprints[job][' '.join(args)] = fingerprint(artifacts)
+        self.fingerprints[commit] = fingerprints
+        return []
+
+    def run_matrix(self, cargo: Cargo, cmd: str, commit: str, workdir: str) -> List[str]:
+        """Run `cmd` over the feature matrix, once per group of entries with the same fingerprint"""
+        fingerprints = self.fingerprints.get(commit, {}).get(cmd, {})
+        durations = TestDurations(repo_id(workdir)) if cmd == 'test' and self.shard_tests else None
+        groups: Dict[str, List[Command]] = {}
+        for args in self.matrix_args(cargo):
+            key = fingerprints.get(' '.join(args), ' '.join(args))
+            if durations is not None:
+                command: Command = ShardedTestCommand(cargo, args, cargo.jobs or 1, durations)
+            else:
+                command = Command(cmd, cargo, args=args)
+            groups.setdefault(key, []).append(command)
+
+        notes: List[str] = []
+        for group in groups.values():
+            update_notes(notes, group[0].notes_str(), lambda: group[0].run(), commit=commit, workdir=workdir, note_ref='check-commit', subdir=self.workdir_suffix)
+            for member in group[1:]:
+                if not check_is_note(member.notes_str(), workdir, commit=commit, note_ref='check-commit'):
+                    notes.append(member.notes_str() + f" [same build as {group[0].args_str() or 'default features'}]")
+        return notes
+
+    def run_(self, workdir: str, commit: str, cores: int) -> List[str]:
         def run_cargo_cmd(cmd: Command, workdir: str) -> List[str]:
             notes: List[str] = []
             notes_str: str = cmd.notes_str()
             if self.workdir_suffix is not None:
                 notes_str += ' # /' + self.workdir_suffix
-            update_notes(notes, cmd.notes_str(), lambda: cmd.run(), workdir=workdir, note_ref='check-commit')
+            update_notes(notes, cmd.notes_str(), lambda: cmd.run(), commit=commit, workdir=workdir, note_ref='check-commit', subdir=self.workdir_suffix)
             return notes
 
         notes: List[str] = []
-        with TemporaryWorkdir(commit) as workdir:
-            if self.jobs != ['fuzz']:
-                cargo = Cargo(cwd=workdir, cwd_suffix=self.workdir_suffix, version=self.version, fuzz_target=self.fuzz_target, force_default_features=self.force_default_features)
-            if 'fuzz' in self.jobs:
-                cwd_suffix: str = ''
-                if self.workdir_suffix is not None:
-                    cwd_suffix = self.workdir_suffix
-                cwd_suffix += '/' + self.fuzz_dir
-                fuzz_cargo = Cargo(cwd=workdir, cwd_suffix=cwd_suffix, version=self.version, fuzz_target=True, force_default_features=self.force_default_features)
-
-            # Run jobs
-            for job in self.jobs:
-                if job == 'build':
-                    notes += run_cargo_cmd(cargo.BUILD, workdir )
-                    if self.features is not None:
-                        notes += run_cargo_cmd(cargo.build_command(self.features), workdir)
-                        if len(self.features) > 1:
-                            for feature in self.features:
-                                notes += run_cargo_cmd(cargo.build_command([feature]), workdir)
-                elif job == 'test':
-                    notes += run_cargo_cmd(cargo.TEST, workdir)
-                    if self.features is not None:
-                        notes += run_cargo_cmd(cargo.test_command(self.features), workdir)
-                        if len(self.features) > 1:
-                            for feature in self.features:
-                                notes += run_cargo_cmd(cargo.test_command([feature]), workdir)
-                elif job == 'examples':
-                    examples = cargo.toml().get('example')
-                    if examples is not None:
-                        for example in examples:
-                            notes += run_cargo_cmd(cargo.example_command(example), workdir)
-                elif job == 'fuzz':
-                    notes += run_cargo_cmd(fuzz_cargo.test_command(self.features), workdir)
-                    tests = glob.glob(workdir + cwd_suffix + '/*.rs')
-                    for test in tests:
-                        test = test.split('/')[-1][:-3] # strip .rs
-                        command = fuzz_cargo.fuzz_command(test, self.fuzz_iters)
-                        notes += run_cargo_cmd(command, workdir)
+        if self.jobs != ['fuzz']:
+            cargo = Cargo(cwd=workdir, cwd_suffix=self.workdir_suffix, version=self.version, fuzz_target=self.fuzz_target, force_default_features=self.force_default_features, jobs=cores, limits=self.limits)
+        if 'fuzz' in self.jobs:
+            cwd_suffix: str = ''
+            if self.workdir_suffix is not None:
+                cwd_suffix = self.workdir_suffix
+            cwd_suffix += '/' + self.fuzz_dir
+            fuzz_cargo = Cargo(cwd=workdir, cwd_suffix=cwd_suffix, version=self.version, fuzz_target=True, force_default_features=self.force_default_features, jobs=cores, limits=self.limits)
+
+        # Run jobs
+        for job in self.jobs:
+            if job == 'build':
+                notes += self.run_matrix(cargo, 'build', commit, workdir)
+            elif job == 'test':
+                notes += self.run_matrix(cargo, 'test', commit, workdir)
+            elif job == 'examples':
+                examples = cargo.toml().get('example')
+                if examples is not None:
+                    for example in examples:
+                        notes += run_cargo_cmd(cargo.example_command(example), workdir)
+            elif job == 'fuzz':
+                notes += run_cargo_cmd(fuzz_cargo.test_command(self.features), workdir)
+                tests = sorted(test.split('/')[-1][:-3] for test in glob.glob(workdir + cwd_suffix + '/*.rs')) # strip .rs
+                if len(tests) == 0:
+                    continue
+
+                # Targets share the cores, and (if there is one) the time budget
+                parallel = min(len(tests), cores)
+                seconds = max(1, self.fuzz_time * parallel // len(tests)) if self.fuzz_time is not None else None
+                commands = [fuzz_cargo.fuzz_command(test, self.fuzz_iters, seconds=seconds, threads=max(1, cores // parallel), corpus=FuzzCorpus(corpus_key(workdir, cwd_suffix, test))) for test in tests]
+                # Targets which crashed before start first, since they are the likeliest to crash again;
+                # each replays its reproducers as part of its own command, so that is what gets noted
+                commands.sort(key=lambda command: command.corpus is None or len(command.corpus.reproducers()) == 0)
+                # Before the targets share it, so the lockfile is settled once
+                fuzz_cargo.initialize()
+                with futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+                    for fuzz_notes in executor.map(lambda command: run_cargo_cmd(command, workdir), commands):
+                        notes += fuzz_notes
+        self.fingerprints.pop(commit, None)
         return notes
 
 
@@ -1,23 +1,26 @@
 #!/bin/python
 
-from concurrent import futures
-import subprocess
 from typing import List
 
 from checks import Check
 from util import colors, now_str
-from util.git import TemporaryWorkdir 
 from util.notes import update_notes
+from util.process import run_logged
+from util.scheduler import Job
+from util.toolchain import wasm_pack_version
 
 class WasmPackCheck(Check):
     TYPE = 'wasm-pack'
+    CORES = 2
+    MEM = 2048
 
     def __init__(self, json):
         super().__init__(json)
         self.features = json.get('features')
 
-        ver_str = subprocess.check_output(["wasm-pack", "--version"])
-        self.full_ver_str = ver_str.decode('ascii').strip()
+    @property
+    def full_ver_str(self) -> str:
+        return wasm_pack_version()
 
     def notes_str(self, features):
         prefix = f"{self.full_ver_str}"
@@ -32,23 +35,22 @@ class WasmPackCheck(Check):
         prefix += f" # {now_str()} / {self.full_ver_str}"
         return prefix
 
-    def run(self, executor: futures.ThreadPoolExecutor, commit: str, notes: List[str]):
-        with TemporaryWorkdir(commit) as workdir:
-            def real_run(features):
-                cmd = ['wasm-pack', 'test', '--node' ]
-                if features is not None:
-                    cmd += [ '--', f"--features={' '.join(features)}"]
-
-                print(self.run_str(features))
-                completed = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=workdir)
-                if completed.returncode != 0:
-                    print ("Command failed:", ' '.join(cmd))
-                    print (completed.stderr.decode("ascii"))
-                    completed.check_returncode() # trigger an exception
-
-            update_notes(notes, self.notes_str(None), lambda: real_run(None), workdir=workdir, note_ref='check-commit')
-            if self.features is not None:
-                update_notes(notes, self.notes_str(self.features), lambda: real_run(self.features), workdir=workdir, note_ref='check-commit')
-                for feature in self.features:
-                    update_notes(notes, self.notes_str([feature]), lambda: real_run([feature]), workdir=workdir, note_ref='check-commit')
-
+    def make_jobs(self, commit: str) -> List[Job]:
+        return [Job(f"wasm-pack test on {str(commit)[:12]}", lambda job: self.run(job.workdir, commit), cores=self.cores, mem=self.mem, worktree=commit)]
+
+    def run(self, workdir: str, commit: str) -> List[str]:
+        notes: List[str] = []
+        def real_run(features):
+            cmd = ['wasm-pack', 'test', '--node' ]
+            if features is not None:
+                cmd += [ '--', f"--features={' '.join(features)}"]
+
+            print(self.run_str(features))
+            return run_logged(cmd, cwd=workdir, kind='wasm-pack', limits=self.limits('test'))
+
+        update_notes(notes, self.notes_str(None), lambda: real_run(None), commit=commit, workdir=workdir, note_ref='check-commit')
+        if self.features is not None:
+            update_notes(notes, self.notes_str(self.features), lambda: real_run(self.features), commit=commit, workdir=workdir, note_ref='check-commit')
+            for feature in self.features:
+                update_notes(notes, self.notes_str([feature]), lambda: real_run([feature]), commit=commit, workdir=workdir, note_ref='check-commit')
+        return notes
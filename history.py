@@ -0,0 +1,37 @@
+#!/bin/python
+
+import argparse
+import time
+
+from util import colors
+from util.history import History
+
+def main():
+    parser = argparse.ArgumentParser("queries the history of checks run by check.py")
+    parser.add_argument('--since', type=float, default=7, help="only look at checks started in the last this many days (default: 7)")
+    parser.add_argument('--command', '-c', default='%', help="only look at note lines matching this SQL LIKE pattern, e.g. '%%1.56%%test%%' (default: all)")
+    parser.add_argument('--db', help="history database (default: ~/.cache/git-scripts/history.sqlite)")
+    queries = parser.add_subparsers(dest='query', required=True)
+    slow = queries.add_parser('slow', help="the slowest commands, by mean duration")
+    slow.add_argument('--limit', type=int, default=20)
+    queries.add_parser('flaky', help="commands which both passed and failed on the same tree")
+    runs = queries.add_parser('runs', help="individual checks, newest first")
+    runs.add_argument('--commit', help="only checks of commits starting with this")
+    runs.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    history = History(args.db)
+    since = time.time() - args.since * 86400
+    if args.query == 'slow':
+        for command, count, mean, longest in history.slow(since, args.command, args.limit):
+            print(f"{mean:8.1f}s mean {longest:8.1f}s max {count:5d} runs  {command}")
+    elif args.query == 'flaky':
+        for command, tree, passes, failures in history.flaky(since, args.command):
+            print(f"{colors.bold(tree[:12])} {passes:3d} passed {failures:3d} failed  {command}")
+    elif args.query == 'runs':
+        for started, commit, command, duration, status, log_path in history.runs(since, args.command, args.commit, args.limit):
+            when = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(started))
+            print(f"{when} {commit[:12]} {status:6} {duration:8.1f}s  {command}" + (f"  ({log_path})" if log_path else ""))
+
+if __name__ == '__main__':
+    main()
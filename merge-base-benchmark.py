@@ -0,0 +1,95 @@
+#!/bin/python
+
+import argparse
+import subprocess
+import tempfile
+import time
+from typing import List, Tuple
+
+from util import colors
+from util.git import merge_bases
+
+def make_repo(path: str, commits: int, moved: int, tips: int) -> Tuple[List[str], List[str]]:
+    """
+    A repository with `commits` commits on master, with a side branch merged every 100 of them
+
+    Returns the branches which are not merged (each a few commits off
+    recent master) and those which were merged `moved` or more commits ago.
+    """
+    subprocess.check_call(["git", "init", "-q", "-b", "master", path])
+    stream: List[bytes] = []
+    mark = 0
+    def commit(ref: str, parents: List[int], name: str) -> int:
+        nonlocal mark
+        mark += 1
+        message = name.encode('ascii')
+        stream.append(b"commit %s\nmark :%d\ncommitter bench <bench@localhost> %d +0000\ndata %d\n%s\n" % (ref.encode('ascii'), mark, 1_000_000_000 + mark, len(message), message))
+        if len(parents) > 0:
+            stream.append(b"from :%d\n" % parents[0])
+        for parent in parents[1:]:
+            stream.append(b"merge :%d\n" % parent)
+        stream.append(b"M 644 inline file\ndata %d\n%s\n" % (len(message), message))
+        return mark
+
+    master = commit("refs/heads/master", [], "m0")
+    merged: List[str] = []
+    for i in range(1, commits):
+        if i % 100 == 0:
+            side = master
+            for j in range(3):
+                side = commit(f"refs/heads/side{i}", [side], f"s{i}-{j}")
+            master = commit("refs/heads/master", [master, side], f"m{i}")
+            if commits - i >= moved:
+                merged.append(f"side{i}")
+        else:
+            master = commit("refs/heads/master", [master], f"m{i}")
+    unmerged = []
+    for n in range(tips):
+        tip = master - 10 * n
+        for j in range(5):
+            tip = commit(f"refs/heads/pr{n}", [tip], f"pr{n}-{j}")
+        unmerged.append(f"pr{n}")
+    subprocess.run(["git", "fast-import", "--quiet"], input=b"".join(stream), cwd=path, check=True)
+    subprocess.check_call(["git", "reset", "-q", "--hard", "master"], cwd=path)
+    return unmerged, merged[-tips:]
+
+def quadratic_merge_base(master: str, tip: str, cwd: str) -> Tuple[str, List[str]]:
+    """What check.py did before: step back along master until it does not contain `tip`, one git call per step"""
+    i = 0
+    while subprocess.run(["git", "merge-base", "--is-ancestor", tip, f"{master}~{i}"], cwd=cwd).returncode == 0:
+        i += 1
+    base = subprocess.check_output(["git", "merge-base", f"{master}~{i}", tip], cwd=cwd).decode('ascii').strip()
+    commits = subprocess.check_output(["git", "rev-list", "--reverse", "--topo-order", f"{base}..{tip}"], cwd=cwd).decode('ascii').split()
+    return base, commits
+
+def main() -> None:
+    parser = argparse.ArgumentParser("times working out the commits of branches, on a generated repository")
+    parser.add_argument('--commits', type=int, default=50000, help="commits on master (default: 50000)")
+    parser.add_argument('--moved', type=int, default=500, help="how far master has moved since the merged branches were merged (default: 500)")
+    parser.add_argument('--tips', type=int, default=10, help="merged and unmerged branches each (default: 10)")
+    parser.add_argument('--skip-old', action='store_true', help="do not time the old one-git-call-per-step implementation")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='git-merge-base-') as repo:
+        start = time.perf_counter()
+        unmerged, merged = make_repo(repo, args.commits, args.moved, args.tips)
+        print(f"Generated {args.commits} commits in {time.perf_counter() - start:.1f}s")
+
+        for name, tips in [('unmerged', unmerged), ('merged', merged)]:
+            start = time.perf_counter()
+            new = merge_bases("master", tips, cwd=repo)
+            batch = time.perf_counter() - start
+            start = time.perf_counter()
+            for tip in tips:
+                merge_bases("master", [tip], cwd=repo)
+            one = (time.perf_counter() - start) / len(tips)
+            line = f"{colors.bold(name):20} {len(tips)} tips: {batch:.3f}s as a batch, {one:.3f}s each alone"
+            if not args.skip_old:
+                start = time.perf_counter()
+                for tip in tips:
+                    assert quadratic_merge_base("master", tip, repo) == new[tip], tip
+                line += f", {(time.perf_counter() - start) / len(tips):.3f}s each before"
+            print(line)
+
+if __name__ == '__main__':
+    main()
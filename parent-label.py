@@ -1,10 +1,13 @@
 #!/bin/python
 
 import argparse
+import json
+import os
 import regex
-import git
+import subprocess
 
-from util.notes import attach_note, check_is_note
+from util.git import commit_parents, git_common_dir, rev_list
+from util.notes import NotesBatch, check_is_note
 
 class PullRemote:
     def __init__(self, number, tip_commit):
@@ -14,11 +17,12 @@ class PullRemote:
     def __str__(self):
         return f"{{ PR\#{self.number}: self.tip }}"
 
-    def ancestor_list(self, master_list):
+    def ancestor_list(self, graph):
         """
-        List all ancestors of this remote that are not on master_list
+        List all ancestors of this remote that are in `graph`, i.e. not on master
 
-        Includes the tip; returns ancestors in reverse (postfix) order.
+        `graph` maps commit ids to their parents' ids. Includes the tip;
+        returns ancestors in reverse (postfix) order.
         """
         ret = []
         ret_set = set()
@@ -30,54 +34,102 @@ class PullRemote:
 
                 ret.append(tip)
                 ret_set.add(tip)
-                parents = [p for p in tip.parents if p.hexsha not in master_list]
+                parents = [p for p in graph.get(tip, []) if p in graph]
                 if len(parents) > 0:
                     stack.append(parents)
         ret.reverse()
         return ret
 
+def load_watermark(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_watermark(path, watermark):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(watermark, f, indent=1)
+    os.replace(path + '.tmp', path)
+
 def main():
     ## 0. Parse arguments
     parser = argparse.ArgumentParser("Iterates through all refs that look like pull requests and label their respective commits. Usage: parent-label --url-prefix=github_url_prefix --ref-prefix=pr/ [list of master branches]")
     parser.add_argument('--url-prefix', required=True, help="Required. ex. https://github.com/MyOrg/project/pull/")
     parser.add_argument('--remote', required=True, help="Required. cal refs corresponding to PRs. Will search refs of the form <ref_prefix>/N/head ex. pr/")
+    parser.add_argument('--incremental', action='store_true', help="Only label PRs whose tips moved since the last run (all of them if a master branch moved)")
 
     args, unknown_args = parser.parse_known_args()
     if len(unknown_args) == 0:
         unknown_args = ['master']
 
     ## 1. Search refs to find PRs
-    repo = git.Repo()
     pr_list = []
-    for ref in repo.refs:
-        if isinstance(ref, git.RemoteReference) and ref.remote_name == args.remote:
-            n = ref.remote_head.split('/', 2)
-            if n[1] == "head":
-                pr_list.append(PullRemote(n[0], ref.commit))
+    prefix = f"refs/remotes/{args.remote}/"
+    refs = subprocess.check_output(["git", "for-each-ref", "--format=%(objectname) %(refname)", prefix]).decode('utf-8')
+    for line in refs.splitlines():
+        sha, ref = line.split(' ', 1)
+        n = ref[len(prefix):].split('/', 2)
+        if len(n) > 1 and n[1] == "head":
+            pr_list.append(PullRemote(n[0], sha))
 
     print (f"Found {len(pr_list)} PRs.")
 
-    ## 2. Get list of "on master" commits
-    main_branch = set()
-    for master in unknown_args:
-        tip = repo.rev_parse(master)
-        while len(tip.parents) > 0:
-            main_branch.add(tip.hexsha)
-            tip = tip.parents[0]
-        main_branch.add(tip.hexsha) # initial commit
-        print (f"Found {len(main_branch)} commits on main branch (searched from {master}).")
-
-    ## 3. For each PR, run through its ancestors that are not on the master list
+    ## 2. Resolve master branches, and drop PRs which have not moved since last time
+    masters = subprocess.check_output(["git", "rev-parse"] + unknown_args).decode('ascii').split()
+    watermark_path = os.path.join(git_common_dir(), 'parent-label', args.remote + '.json')
+    watermark = {
+        'url-prefix': args.url_prefix,
+        'masters': dict(zip(unknown_args, masters)),
+        'prs': {pr.number: pr.tip_commit for pr in pr_list},
+    }
+    if args.incremental:
+        old = load_watermark(watermark_path)
+        if old.get('url-prefix') == watermark['url-prefix'] and old.get('masters') == watermark['masters']:
+            old_prs = old.get('prs', {})
+            pr_list = [pr for pr in pr_list if old_prs.get(pr.number) != pr.tip_commit]
+            print (f"{len(pr_list)} PRs moved since the last run.")
+        else:
+            print ("Master branches moved since the last run; relabelling everything.")
+
+    ## 3. Walk every PR at once, stopping at the first-parent history of the masters
+    main_branch = set(line[0] for line in rev_list(['--first-parent'], masters))
+    print (f"Found {len(main_branch)} commits on main branch (searched from {', '.join(unknown_args)}).")
+
+    graph = {}
+    if len(pr_list) > 0:
+        revs = [pr.tip_commit for pr in pr_list] + ['^' + master for master in masters]
+        for line in rev_list(['--parents'], revs):
+            graph[line[0]] = line[1:]
+
+    # PRs which were merged into a master (not by fast-forward) are hidden by
+    # the `^master` above, although they are not on its first-parent history.
+    # Walk those the rest of the way a generation at a time.
+    todo = [pr.tip_commit for pr in pr_list] + [p for parents in graph.values() for p in parents]
+    while len(todo) > 0:
+        todo = set(c for c in todo if c not in graph and c not in main_branch)
+        found = commit_parents(todo)
+        graph.update(found)
+        todo = [p for parents in found.values() for p in parents]
+    print (f"Found {len(graph)} commits not on main branch.")
+
+    ## 4. For each PR, run through its ancestors that are not on the master list
+    batch = NotesBatch("label-pr")
     for pr in pr_list:
-        ancestor_list = pr.ancestor_list(main_branch)
+        ancestor_list = pr.ancestor_list(graph)
         noted = 0
         for n, ancestor in enumerate(ancestor_list, start=1):
             new_note = f"PR: {args.url_prefix}{pr.number} ({n}/{len(ancestor_list)})"
             if not check_is_note(new_note, ".", commit=ancestor, note_ref="label-pr"):
-                attach_note(new_note, commit=ancestor, note_ref="label-pr")
+                batch.append(new_note, commit=ancestor)
                 noted += 1
         print (f"PR {args.url_prefix}{pr.number}: noted {noted}/{len(ancestor_list)}")
 
+    ## 5. Write all the new labels as one notes commit
+    print (f"Writing notes for {len(batch)} commits.")
+    batch.flush()
+    save_watermark(watermark_path, watermark)
+
 if __name__ == '__main__':
     main()
-
@@ -1,17 +1,64 @@
 #!/bin/python
 
 import argparse
+import re
+from typing import Dict, List
 
-from util.notes import attach_note
+from util import colors, log
+from util.git import rev_list
+from util.notes import NotesBatch, normalize, notes_index
+from util.patchid import PatchIdIndex
+
+# The date NotesBatch puts above every message
+DATE_LINE = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d$')
+
+def carry(revs: List[str], batch: NotesBatch) -> int:
+    """
+    Copy review notes onto the commits in `revs` which have the same patch-id as a reviewed commit
+
+    Commits which already have a review are left alone. Each carried line
+    says where it came from. Returns how many commits were noted.
+    """
+    index = notes_index(batch.note_ref)
+    targets = [line[0] for line in rev_list([], revs)]
+    unreviewed = [commit for commit in targets if index.get(commit) is None]
+    if len(unreviewed) == 0:
+        return 0
+    reviewed = list(index.text)
+
+    ids = PatchIdIndex()
+    found = ids.get(reviewed + unreviewed)
+    ids.save()
+    review_of: Dict[str, str] = { found[commit]: commit for commit in reviewed if commit in found }
+
+    carried = 0
+    for commit in unreviewed:
+        source = review_of.get(found.get(commit, ''))
+        if source is None:
+            continue
+        lines = [normalize(line) for line in (index.get(source) or '').splitlines() if line.strip() and not DATE_LINE.match(line)]
+        lines = list(dict.fromkeys(lines))
+        log(f"{colors.magenta('Carrying')} review of {colors.bold(source)} to {colors.bold(commit)}")
+        batch.append("\n".join(f"{line} [carried from {source}]" for line in lines), commit=commit)
+        carried += 1
+    return carried
 
 def main():
     parser = argparse.ArgumentParser("sticks an OK message on a given commit")
     parser.add_argument('--message', '-m', default='OK', help="message to put in the note (default: OK)")
-    parser.add_argument('--commit', '-c', default='HEAD', help="commit to add the note to (default: HEAD)")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--commit', '-c', action='append', help="commit to add the note to; may be repeated (default: HEAD)")
+    target.add_argument('--carry', metavar='RANGE', action='append', help="instead, copy the reviews of commits with the same patch-id onto the unreviewed commits of RANGE, e.g. master..pr; may be repeated")
     args = parser.parse_args()
 
-    attach_note(args.message, commit=args.commit, note_ref="review")
+    batch = NotesBatch("review")
+    if args.carry is not None:
+        carried = carry(args.carry, batch)
+        log(f"Carried reviews to {carried} commits")
+    else:
+        for commit in args.commit or ['HEAD']:
+            batch.append(args.message, commit=commit)
+    batch.flush()
 
 if __name__ == '__main__':
     main()
-
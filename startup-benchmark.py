@@ -0,0 +1,71 @@
+#!/bin/python
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from util import cache_dir, colors
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# What is timed: the commands a git hook or a quick review runs, which should be dominated by git, not by imports
+COMMANDS: Dict[str, List[str]] = {
+    'review.py -m OK': ['review.py', '-m', 'OK'],
+    'check.py --help': ['check.py', '--help'],
+    'check-daemon.py --help': ['check-daemon.py', '--help'],
+    'history.py --help': ['history.py', '--help'],
+}
+
+def time_command(argv: List[str], cwd: str, env: Dict[str, str], runs: int) -> List[float]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(HERE, argv[0])] + argv[1:], cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main() -> None:
+    parser = argparse.ArgumentParser("times how long the scripts take to start, and compares with the last run")
+    parser.add_argument('--runs', type=int, default=10, help="times to run each command (default: 10)")
+    parser.add_argument('--max', type=float, metavar='SECONDS', help="exit with an error if any command's median exceeds this")
+    parser.add_argument('--no-record', action='store_true', help="do not record the results for later comparison")
+    args = parser.parse_args()
+
+    record = os.path.join(cache_dir(), 'startup-benchmark.jsonl')
+    last: Dict[str, float] = {}
+    try:
+        with open(record) as f:
+            for line in f:
+                last = json.loads(line)['median']
+    except FileNotFoundError:
+        pass
+
+    medians: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory(prefix='git-startup-') as repo:
+        # review.py writes a note, so give it a repository of its own
+        env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost', GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+        subprocess.check_call(["git", "init", "-q", repo])
+        subprocess.check_call(["git", "commit", "-q", "--allow-empty", "-m", "bench"], cwd=repo, env=env)
+        for name, argv in COMMANDS.items():
+            times = time_command(argv, repo, env, args.runs)
+            medians[name] = statistics.median(times)
+            change = f" ({medians[name] - last[name]:+.3f}s since last run)" if name in last else ""
+            print(f"{colors.bold(name):40} median {medians[name]:.3f}s min {min(times):.3f}s{change}")
+
+    if not args.no_record:
+        head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('ascii').strip()
+        with open(record, 'a') as f:
+            f.write(json.dumps({ 'time': time.time(), 'commit': head, 'median': medians }) + "\n")
+
+    if args.max is not None and max(medians.values()) > args.max:
+        print(f"{colors.yellow('Too slow')}: {max(medians, key=medians.__getitem__)} took longer than {args.max}s to start")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
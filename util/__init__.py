@@ -1,4 +1,5 @@
 
+import os
 import threading
 import time
 
@@ -8,3 +9,10 @@ def now_str() -> str:
 def log(s: str):
     print(f"{now_str()} {threading.current_thread().name}-{threading.current_thread().ident}: {s}")
 
+
+def cache_dir(*parts: str) -> str:
+    """A directory under the user's cache dir (~/.cache/git-scripts), created if need be"""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(root, 'git-scripts', *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -1,13 +1,156 @@
 
+import fcntl
+import hashlib
+import json
 import os
+import re
+import shutil
 import subprocess
-import toml
-from typing import Any, Dict, List, MutableMapping, Optional
+import tempfile
+import threading
+import time
+from concurrent import futures
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, MutableMapping, Optional
+
+from util import cache_dir, colors, log
+from util.fuzz import FuzzCorpus
+from util.git import repo_id
+from util.process import CommandFailed, Limits, RunResult, run_logged
+from util.shards import TestDurations, balance
+from util.toolchain import rust_release, rust_version
+
+class TargetCache:
+    """
+    Cargo target directories shared between worktrees and commits
+
+    Every worktree used to get its own `target/`, so all dependencies were
+    rebuilt for every commit and toolchain. Here target directories are
+    keyed by repository (and crate within it), toolchain, fuzz cfg flags
+    and feature set, so unrelated crates do not evict each other. Each key
+    has a few slots, each of which is flock()ed while a cargo command uses
+    it, so parallel checks with the same key neither clobber nor wait for
+    each other unless all slots are busy. `cleanup` evicts the least recently
+    used directories once the cache grows past `max_bytes`.
+    """
+    def __init__(self, max_bytes: int, root: Optional[str] = None, slots_per_key: int = 4):
+        self.root: str = root or cache_dir('cargo-target')
+        self.max_bytes: int = max_bytes
+        self.slots_per_key: int = slots_per_key
+
+    @contextmanager
+    def lease(self, key: str):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        lock = None
+        for i in range(self.slots_per_key):
+            path = os.path.join(self.root, f"{name}-{i}")
+            lock = open(path + '.lock', 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                lock.close()
+                lock = None
+        if lock is None:
+            # All slots busy; queue up behind the first one
+            path = os.path.join(self.root, f"{name}-0")
+            lock = open(path + '.lock', 'w')
+            fcntl.flock(lock, fcntl.LOCK_EX)
 
-from util import colors, log
+        try:
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, '.key'), 'w') as f:
+                f.write(key + '\n')
+            yield path
+        finally:
+            os.utime(path)
+            lock.close()
+
+    def cleanup(self) -> None:
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            size = 0
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    try:
+                        size += os.lstat(os.path.join(dirpath, filename)).st_size
+                    except FileNotFoundError:
+                        pass
+            entries.append((os.stat(path).st_mtime, size, path))
+            total += size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            with open(path + '.lock', 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue # in use
+                log(f"{colors.magenta('Evicting')} cargo target dir {path} ({size >> 20} MiB)")
+                shutil.rmtree(path)
+                total -= size
+
+class LockfileCache:
+    """
+    Resolved Cargo.lock files, so that dependency resolution happens once per manifest
+
+    Lockfiles are keyed by the contents of every Cargo.toml in the crate,
+    the toolchain version and the versions pinned for old toolchains.
+    Entries older than `max_age` seconds are re-resolved so that new
+    dependency releases still get tested, except in offline mode, where
+    any entry is better than failing.
+    """
+    def __init__(self, max_age: float, root: Optional[str] = None):
+        self.root: str = root or cache_dir('cargo-lock')
+        self.max_age: float = max_age
+
+    def key(self, cargo: 'Cargo') -> str:
+        h = hashlib.sha256()
+        h.update(cargo.full_ver_str.encode('utf-8') + b"\0")
+        for command in cargo.init_commands:
+            h.update(' '.join(command.args).encode('utf-8') + b"\0")
+        for dirpath, dirnames, filenames in os.walk(cargo.cwd):
+            dirnames[:] = sorted(d for d in dirnames if d != 'target' and not d.startswith('.'))
+            if 'Cargo.toml' in filenames:
+                path = os.path.join(dirpath, 'Cargo.toml')
+                h.update(os.path.relpath(path, cargo.cwd).encode('utf-8') + b"\0")
+                with open(path, 'rb') as f:
+                    h.update(f.read() + b"\0")
+        return h.hexdigest()
+
+    def restore(self, key: str, cwd: str) -> bool:
+        path = os.path.join(self.root, key + '.lock')
+        try:
+            if not offline and time.time() - os.stat(path).st_mtime > self.max_age:
+                return False
+            shutil.copyfile(path, os.path.join(cwd, 'Cargo.lock'))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def store(self, key: str, cwd: str) -> None:
+        path = os.path.join(self.root, key + '.lock')
+        try:
+            shutil.copyfile(os.path.join(cwd, 'Cargo.lock'), path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except FileNotFoundError:
+            pass # e.g. a workspace member, whose lockfile is somewhere above it
+
+# Shared target directories, if enabled (see check.py --target-cache-size)
+target_cache: Optional[TargetCache] = None
+# Resolved lockfiles, if enabled (see check.py --lockfile-max-age)
+lockfile_cache: Optional[LockfileCache] = None
+# Never touch the network; rely on the lockfile cache and cargo's local registry cache
+offline: bool = False
 
 class Cargo:
-    def __init__(self, version: Optional[str] = None, cwd: str = '.', cwd_suffix: Optional[str] = None, fuzz_target: bool = False, force_default_features: bool = False):
+    def __init__(self, version: Optional[str] = None, cwd: str = '.', cwd_suffix: Optional[str] = None, fuzz_target: bool = False, force_default_features: bool = False, jobs: Optional[int] = None, limits: Optional[Callable[[str], Limits]] = None):
         self.cwd: str = cwd
         self.version: str = version or 'stable'
         if cwd_suffix is not None:
@@ -15,14 +158,9 @@ class Cargo:
         self.cwd_suffix: Optional[str] = cwd_suffix
         self.fuzz_target: bool = fuzz_target
         self.force_default_features: bool = force_default_features
-
-        ver_str: bytes = subprocess.check_output(["cargo", "+" + self.version, "-V"])
-        self.full_ver_str: str = ver_str.decode('ascii').strip()
-
-        try:
-            os.unlink(self.cwd + '/Cargo.lock')
-        except:
-            pass
+        self.jobs: Optional[int] = jobs
+        # The limits of each cargo subcommand, e.g. 'test'; see checks.Check.limits
+        self.limits: Callable[[str], Limits] = limits or (lambda command: Limits())
 
         self.UPDATE: Command = Command("update", self)
         self.BUILD: Command = Command("build", self)
@@ -37,33 +175,61 @@ class Cargo:
             self.init_commands.append(FixVersionCommand("serde_derive", "1.0.98", self))
 
         self.initialized: bool = False
+        self.initializing: bool = False
+        self.initialize_lock = threading.RLock()
+
+    @property
+    def full_ver_str(self) -> str:
+        return rust_version(self.version)
 
     def initialize(self) -> None:
-        if self.initialized:
-            return
-        self.initialized = True
+        # Other threads wait until the lockfile is ready; the init commands are
+        # cargo commands too, so this thread comes back here while they run
+        with self.initialize_lock:
+            if self.initialized or self.initializing:
+                return
+            self.initializing = True
+            try:
+                self._initialize()
+                self.initialized = True
+            finally:
+                self.initializing = False
+
+    def _initialize(self) -> None:
+        try:
+            os.unlink(self.cwd + '/Cargo.lock')
+        except:
+            pass
+
+        if lockfile_cache is not None:
+            key = lockfile_cache.key(self)
+            if lockfile_cache.restore(key, self.cwd):
+                log(f"{colors.magenta('Restored')} cached Cargo.lock for {self.cwd}")
+                return
 
         for command in self.init_commands:
             command.run()
 
-    def build_command(self, features: Optional[List[str]]):
-        ret = self.BUILD
+        if lockfile_cache is not None:
+            lockfile_cache.store(key, self.cwd)
+
+    def feature_args(self, features: Optional[List[str]]) -> List[str]:
         if self.force_default_features:
-            ret.args = []
+            args = []
         else:
-            ret.args = ['--no-default-features']
+            args = ['--no-default-features']
         if features is not None:
-            ret.args += [ f"--features={' '.join(features)}" ]
+            args += [ f"--features={' '.join(features)}" ]
+        return args
+
+    def build_command(self, features: Optional[List[str]]):
+        ret = self.BUILD
+        ret.args = self.feature_args(features)
         return ret
 
     def test_command(self, features: Optional[List[str]]):
         ret = self.TEST
-        if self.force_default_features:
-            ret.args = []
-        else:
-            ret.args = ['--no-default-features']
-        if features is not None:
-            ret.args += [ f"--features={' '.join(features)}" ]
+        ret.args = self.feature_args(features)
         return ret
 
     def example_command(self, example_toml: Dict[str, str]):
@@ -73,12 +239,18 @@ class Cargo:
             ret.args += [ f"--features={' '.join(example_toml['required-features'])}" ]
         return ret
 
-    def fuzz_command(self, test_case: str, iters: int = 100000):
-        return FuzzCommand(test_case, iters, self)
+    def fuzz_command(self, test_case: str, iters: int = 100000, seconds: Optional[int] = None, threads: int = 1, corpus: Optional[FuzzCorpus] = None):
+        return FuzzCommand(test_case, iters, self, seconds=seconds, threads=threads, corpus=corpus)
 
     def toml(self) -> MutableMapping[str, Any]:
+        import toml # only needed by a few checks, and slow to import
         return toml.load(self.cwd + '/Cargo.toml')
 
+    def target_key(self, args: List[str]) -> str:
+        """Which shared target directory a command with these arguments should use"""
+        features = [arg for arg in args if arg.startswith('--features') or arg.endswith('default-features')]
+        return f"{repo_id(self.cwd)}/{self.cwd_suffix or ''} {self.full_ver_str} fuzz={self.fuzz_target} {' '.join(features)}"
+
 class Command:
     def __init__(self, cmd: str, cargo: Cargo, args=None, allow_fail=False):
         self.cmd: str = cmd
@@ -117,7 +289,7 @@ class Command:
             prefix += "# '--cfg=rust_secp_fuzz'"
         return prefix
 
-    def run(self, env: Optional[Dict[str, str]]=None) -> str:
+    def environment(self, env: Optional[Dict[str, str]]=None) -> Dict[str, str]:
         if env is None:
             env = os.environ.copy()
         else:
@@ -126,51 +298,206 @@ class Command:
         if self.cargo.fuzz_target:
             env['RUSTFLAGS'] = (env.get('RUSTFLAGS') or '') + '--cfg=rust_secp_fuzz'
             env['RUSTDOCFLAGS'] = (env.get('RUSTDOCFLAGS') or '') + '--cfg=rust_secp_fuzz'
+        if self.cargo.jobs is not None:
+            env['CARGO_BUILD_JOBS'] = str(self.cargo.jobs)
+        if offline:
+            env['CARGO_NET_OFFLINE'] = 'true'
+        return env
+
+    @contextmanager
+    def target_dir(self, env: Dict[str, str]):
+        """Point `env` at a shared target directory for the duration, if this command builds"""
+        if target_cache is not None and self.cmd in ('build', 'check', 'test', 'run'):
+            with target_cache.lease(self.cargo.target_key(self.args)) as target_dir:
+                env['CARGO_TARGET_DIR'] = target_dir
+                yield target_dir
+        else:
+            yield None
 
+    def run(self, env: Optional[Dict[str, str]]=None, on_line: Optional[Callable[[str], None]]=None) -> RunResult:
+        env = self.environment(env)
         self.cargo.initialize()
         cmd = [ "cargo", "+" + self.cargo.version, self.cmd ]
         for arg in self.args:
             cmd.append(arg)
 
         log(self.run_str())
-        completed = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.cargo.cwd, env=env)
-        if completed.returncode != 0:
-            if self.allow_fail:
-                log ("## (above command failed, continuing)")
-            else:
-                log ("Command failed:", ' '.join(cmd))
-                log (completed.stderr.decode("ascii"))
-                completed.check_returncode() # trigger an exception
-
-        return completed.stdout.decode("ascii")
-
+        with self.target_dir(env):
+            result = run_logged(cmd, cwd=self.cargo.cwd, env=env, check=not self.allow_fail, kind='cargo', on_line=on_line, limits=self.cargo.limits(self.cmd))
+        if result.returncode != 0:
+            log ("## (above command failed, continuing)")
+        return result
+
+class ShardedTestCommand(Command):
+    """
+    `cargo test`, with the tests spread over `shards` processes at a time
+
+    The test binaries are built once with --no-run, each is asked for its
+    tests, and the tests are split between shards by how long they took
+    last time, longest first. Each shard runs its tests one at a time, so
+    how long each one takes can be read off its output, and fails unless
+    every one of them reported a result. Toolchains whose test harness
+    only takes a single filter, or whose cargo does not say where the
+    test binaries are, run plain `cargo test` instead, as does a crate in
+    which no tests were found.
+    """
+    TEST_RESULT = re.compile(r'^test (\S+) \.\.\. (ok|FAILED|ignored)')
+    # libtest takes several test names at once since 1.52
+    MIN_RELEASE = (1, 52)
+
+    def __init__(self, cargo: Cargo, args: List[str], shards: int, durations: TestDurations):
+        super().__init__("test", cargo, args=args)
+        self.shards = shards
+        self.durations = durations
+
+    def run(self, env=None, on_line=None) -> RunResult:
+        if rust_release(self.cargo.full_ver_str) < self.MIN_RELEASE:
+            return super().run(env, on_line)
+        test_env = self.environment(None if env is None else dict(env))
+        self.cargo.initialize()
+        log(self.run_str() + " (sharded)")
+        with self.target_dir(test_env):
+            executables: Dict[str, Dict[str, str]] = {}
+            def on_artifact(line: str) -> None:
+                if line.startswith('{'):
+                    message = json.loads(line)
+                    if message.get('reason') == 'compiler-artifact' and message.get('executable') and message['profile']['test']:
+                        binary = f"{'+'.join(message['target']['kind'])}/{message['target']['name']}"
+                        executables[binary] = { 'path': message['executable'], 'manifest_dir': os.path.dirname(message['manifest_path']) }
+            limits = self.cargo.limits(self.cmd)
+            run_logged(["cargo", "+" + self.cargo.version, "test", "--no-run", "--message-format=json"] + self.args, cwd=self.cargo.cwd, env=test_env, kind='cargo', on_line=on_artifact, limits=limits)
+
+            # Binaries without the libtest harness cannot list their tests; they are run whole
+            manifest = self.cargo.toml()
+            no_harness = set(f"{kind}/{target['name']}" for kind in ('test', 'bench') for target in manifest.get(kind, []) if not target.get('harness', True))
+            tests: List[str] = []
+            for binary, exe in executables.items():
+                if binary in no_harness:
+                    tests.append(f"{binary}::")
+                    continue
+                listing = subprocess.check_output([exe['path'], "--list"], cwd=exe['manifest_dir'], env=dict(test_env, CARGO_MANIFEST_DIR=exe['manifest_dir'])).decode('utf-8', errors='replace')
+                tests += [f"{binary}::{line[:-len(': test')]}" for line in listing.splitlines() if line.endswith(': test')]
+
+            if len(tests) > 0:
+                units: List[Callable[[], None]] = [lambda shard=shard: self.run_shard(shard, executables, test_env) for shard in balance(tests, self.shards, self.durations)]
+                if os.path.exists(os.path.join(self.cargo.cwd, 'src', 'lib.rs')) or 'lib' in manifest:
+                    units.append(lambda: run_logged(["cargo", "+" + self.cargo.version, "test", "--doc"] + self.args, cwd=self.cargo.cwd, env=test_env, kind='cargo', limits=limits))
+                log(f"{len(tests)} tests from {len(executables)} binaries in {len(units)} shards")
+
+                with futures.ThreadPoolExecutor(max_workers=self.shards) as executor:
+                    futs = [executor.submit(unit) for unit in units]
+                    futures.wait(futs)
+        if len(tests) == 0:
+            log(f"No tests found in {len(executables)} test binaries; running plain cargo test")
+            return super().run(env, on_line)
+        self.durations.save()
+        for fut in futs:
+            fut.result() # raise the first failure, if any
+        return RunResult(0, [], '')
+
+    def run_shard(self, shard: List[str], executables: Dict[str, Dict[str, str]], env: Dict[str, str]) -> None:
+        by_binary: Dict[str, List[str]] = {}
+        for test in shard:
+            binary, name = test.split('::', 1)
+            by_binary.setdefault(binary, []).append(name)
+
+        limits = self.cargo.limits(self.cmd)
+        for binary, names in by_binary.items():
+            exe = executables[binary]
+            last = time.time()
+            results = 0
+            def on_line(line: str, binary=binary) -> None:
+                nonlocal last, results
+                match = self.TEST_RESULT.match(line)
+                if match is not None:
+                    now = time.time()
+                    if match.group(2) != 'ignored':
+                        self.durations.record(f"{binary}::{match.group(1)}", now - last)
+                    last = now
+                    results += 1
+            if names == ['']:
+                run_logged([exe['path']], cwd=exe['manifest_dir'], env=dict(env, CARGO_MANIFEST_DIR=exe['manifest_dir']), kind='cargo-test', limits=limits)
+                continue
+            for i in range(0, len(names), 500): # keep the command line to a sane length
+                chunk = names[i:i + 500]
+                cmd = [exe['path'], "--exact", "--test-threads=1"] + chunk
+                results = 0
+                result = run_logged(cmd, cwd=exe['manifest_dir'], env=dict(env, CARGO_MANIFEST_DIR=exe['manifest_dir']), kind='cargo-test', on_line=on_line, limits=limits)
+                # A harness which silently ran fewer tests than it was given must not pass
+                if results != len(chunk):
+                    log(f"{binary} reported {results} results for {len(chunk)} tests")
+                    raise CommandFailed(1, cmd, result.tail, result.log_path)
 
 class FixVersionCommand(Command):
     def __init__(self, package: str, version: str, cargo: Cargo):
         super().__init__("update", cargo, args=["-p", package, "--precise", version], allow_fail=True)
 
 class FuzzCommand(Command):
-    def __init__(self, test_case: str, iters: int, cargo: Cargo):
+    """
+    `cargo hfuzz run` one target, for `iters` iterations or, if given, `seconds`
+
+    With a corpus, the reproducers of earlier crashes are run first, then
+    the fuzzer starts from the corpus and what it finds is merged back.
+    Crashing inputs are added to the corpus's reproducers, and the command
+    fails; honggfuzz itself exits successfully upon a crash.
+    """
+    def __init__(self, test_case: str, iters: int, cargo: Cargo, seconds: Optional[int] = None, threads: int = 1, corpus: Optional[FuzzCorpus] = None):
         super().__init__("hfuzz", cargo, args=["run", test_case])
         self.iters = iters
+        self.seconds = seconds
+        self.threads = threads
+        self.corpus = corpus
 
-    def run(self, env=None):
-        if env is None:
-            env = os.environ.copy()
-        else:
-            env |= os.environ.copy()
-
+    def hfuzz(self, run_args: List[str], workdir: str, input: Optional[str]) -> None:
+        """Run honggfuzz with `run_args`, failing if it found any crashing inputs"""
+        env = os.environ.copy()
         env['HFUZZ_BUILD_ARGS'] = '--features honggfuzz_fuzz'
-        env['HFUZZ_RUN_ARGS'] = '--exit_upon_crash -v -N' + str(self.iters)
-        super().run(env=env)
+        env['HFUZZ_RUN_ARGS'] = ' '.join(['--exit_upon_crash', '-v', '-n', str(self.threads), '--crashdir', workdir + '/crashes'] + run_args)
+        env['HFUZZ_WORKSPACE'] = workdir + '/workspace'
+        if input is not None:
+            env['HFUZZ_INPUT'] = input
+        result = super().run(env=env)
+        crashes = os.path.join(workdir, 'crashes')
+        found = [name for name in os.listdir(crashes) if name.endswith('.fuzz')] if os.path.isdir(crashes) else []
+        if len(found) > 0:
+            if self.corpus is not None:
+                self.corpus.merge(crashes, crashes=True)
+            log(f"{self.args[1]} crashed on {len(found)} inputs; see {crashes if self.corpus is None else self.corpus.crashes}")
+            raise CommandFailed(1, ["cargo", "hfuzz"] + self.args, result.tail, result.log_path)
+
+    def replay(self) -> None:
+        """Run the reproducers of earlier crashes, failing if any still crashes"""
+        if self.corpus is None or len(self.corpus.reproducers()) == 0:
+            return
+        with tempfile.TemporaryDirectory(prefix='git-check-fuzz-') as workdir:
+            log(f"Re-running {len(self.corpus.reproducers())} crash reproducers of {self.args[1]}")
+            self.hfuzz(['--mutations_per_run', '0', '-N', str(len(self.corpus.reproducers())), '--output', workdir + '/new'], workdir, self.corpus.crashes)
+
+    def run(self, env=None):
+        self.replay()
+        with tempfile.TemporaryDirectory(prefix='git-check-fuzz-') as workdir:
+            if self.corpus is not None and self.corpus.needs_minimizing():
+                self.hfuzz(['--minimize', '--output', workdir + '/minimized'], workdir, self.corpus.corpus)
+                self.corpus.replace(workdir + '/minimized')
+
+            run_args = ['--run_time', str(self.seconds)] if self.seconds is not None else ['-N', str(self.iters)]
+            if self.corpus is not None:
+                run_args += ['--output', workdir + '/new']
+            self.hfuzz(run_args, workdir, None if self.corpus is None else self.corpus.corpus)
+            if self.corpus is not None:
+                self.corpus.merge(workdir + '/new')
 
     def notes_str(self):
-        prefix = f"{self.cargo.full_ver_str}) cargo hfuzz run {self.args[1]} # iters {self.iters}"
+        if self.seconds is not None:
+            prefix = f"{self.cargo.full_ver_str} cargo hfuzz run {self.args[1]} # time {self.seconds}s"
+        else:
+            prefix = f"{self.cargo.full_ver_str}) cargo hfuzz run {self.args[1]} # iters {self.iters}"
         if self.cargo.cwd_suffix is not None:
             prefix += ", cwd {self.cargo.cwd_suffix}"
         return prefix
 
     def run_str(self):
         # append after date comment
-        return super().run_str() + " HFUZZ_BUILD_ARGS='--features honggfuzz_fuzz' HFUZZ_RUN_ARGS=-N" + str(self.iters)
+        limit = f"'--run_time {self.seconds}'" if self.seconds is not None else "-N" + str(self.iters)
+        return super().run_str() + " HFUZZ_BUILD_ARGS='--features honggfuzz_fuzz' HFUZZ_RUN_ARGS=" + limit
 
@@ -0,0 +1,76 @@
+
+import fcntl
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from typing import List, Optional
+
+from util import cache_dir, log
+from util.git import repo_id
+
+def corpus_key(cwd: str, cwd_suffix: str, target: str) -> str:
+    """Names the corpus of `target` in the repository at `cwd`, whichever worktree or clone it is"""
+    path = re.sub('[^A-Za-z0-9._-]+', '_', cwd_suffix.strip('/'))
+    return os.path.join(repo_id(cwd), path, target)
+
+class FuzzCorpus:
+    """
+    The corpus and crash reproducers of one fuzz target, kept across commits and runs
+
+    Fuzzers read the corpus and write what they find to a directory of
+    their own, which is merged back afterwards, so several commits can
+    fuzz the same target at once. Honggfuzz names inputs by their
+    contents, so merging is copying whatever is missing. Crashing inputs
+    are kept apart, to be re-run first on later commits.
+    """
+    def __init__(self, key: str, root: Optional[str] = None):
+        self.dir: str = os.path.join(root or cache_dir('fuzz'), key)
+        self.corpus: str = os.path.join(self.dir, 'corpus')
+        self.crashes: str = os.path.join(self.dir, 'crashes')
+        os.makedirs(self.corpus, exist_ok=True)
+        os.makedirs(self.crashes, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def reproducers(self) -> List[str]:
+        return sorted(os.listdir(self.crashes))
+
+    def merge(self, src: str, crashes: bool = False) -> List[str]:
+        """Copy the inputs in `src` we do not have yet into the corpus (or the crashes); returns their names"""
+        dest = self.crashes if crashes else self.corpus
+        if not os.path.isdir(src):
+            return []
+        added = []
+        with self.locked():
+            for name in os.listdir(src):
+                if (crashes and not name.endswith('.fuzz')) or os.path.exists(os.path.join(dest, name)):
+                    continue # honggfuzz also writes a report into the crash directory
+                shutil.copyfile(os.path.join(src, name), os.path.join(dest, name))
+                added.append(name)
+        return added
+
+    def needs_minimizing(self) -> bool:
+        """Whether the corpus has doubled since it was last minimized (and is not tiny)"""
+        try:
+            with open(os.path.join(self.dir, 'minimized')) as f:
+                last = int(f.read())
+        except (FileNotFoundError, ValueError):
+            last = 0
+        return len(os.listdir(self.corpus)) > max(2 * last, 64)
+
+    def replace(self, minimized: str) -> None:
+        """Swap in a minimized copy of the corpus"""
+        with self.locked():
+            old = self.corpus + '.old'
+            shutil.rmtree(old, ignore_errors=True)
+            os.rename(self.corpus, old)
+            shutil.copytree(minimized, self.corpus)
+            shutil.rmtree(old)
+            with open(os.path.join(self.dir, 'minimized'), 'w') as f:
+                f.write(str(len(os.listdir(self.corpus))))
+        log(f"Minimized fuzz corpus {self.corpus}")
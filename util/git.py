@@ -1,43 +1,296 @@
 
-import git # type: ignore
+import hashlib
+import os
 import subprocess
 import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from util import colors, log
+from util import colors, log, profile
+
+def rev_parse(rev: str, cwd: str = '.') -> str:
+    """Resolve `rev` to a full id; raises CalledProcessError if it does not exist (or we are not in a repo)"""
+    return subprocess.check_output(["git", "rev-parse", "--verify", "-q", rev + "^{commit}"], cwd=cwd).decode('ascii').strip()
 
 class TemporaryWorkdir:
     def __init__(self, commit: str='HEAD'):
-        self.commit = git.Git().rev_parse(commit)
+        self.commit = rev_parse(commit)
         self.tempdir = tempfile.TemporaryDirectory()
 
     def __enter__(self):
-        repo = git.Repo() # Throw exception if we are not in a git repo
         log(f"{colors.magenta('Checking out')} commit {colors.bold(str(self.commit))}")
 
         self.tempdir_name = self.tempdir.__enter__()
-        git.Git().worktree("add", "--force", self.tempdir_name, self.commit)
+        with profile.timed(f"worktree add {self.commit}", 'worktree'):
+            subprocess.check_call(["git", "worktree", "add", "-q", "--force", self.tempdir_name, self.commit])
         return self.tempdir_name
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         log(f"{colors.magenta('Remove')} worktree for {colors.bold(str(self.commit))}")
-        git.Git().worktree("remove", "--force", self.tempdir_name)
+        with profile.timed(f"worktree remove {self.commit}", 'worktree'):
+            subprocess.check_call(["git", "worktree", "remove", "--force", self.tempdir_name])
         self.tempdir.__exit__(exc_type, exc_val, exc_tb)
         return False
 
-def actual_merge_base(master: git.Commit, branch: git.Commit) -> git.Commit:
-    repo = git.Repo()
-    i = 0
-    while repo.is_ancestor(branch, f"{master}~{i}"):
-        i += 1
-    return repo.merge_base(f"{master}~{i}", branch)[0]
-
-def cherry_pick(workdir, commit):
-    repo = git.Repo(path=workdir, search_parent_directories=True)
-    with repo.git.custom_environment(GIT_COMMITTER_DATE=str(commit.authored_date)):
-        head = repo.git.rev_parse('HEAD')
-        log(f"{colors.magenta('Cherry-picking')} commit {colors.bold(str(commit))} onto {colors.bold(str(head))}")
-        repo.git.cherry_pick(commit, "--keep-redundant-commits")
-        head = repo.git.rev_parse('HEAD')
-        log(f"{colors.magenta('Cherry-picked')} as {colors.bold(str(head))}")
-        return head
+class WorktreePool:
+    """
+    A fixed number of worktrees which are reused rather than recreated
+
+    Leasing a slot checks it out (detached) to the requested commit and
+    cleans it, so moving between neighbouring commits of a series only
+    touches the files which changed. Slots are created lazily, up to
+    `size`; further leases block until a slot is returned.
+    """
+    def __init__(self, size: int):
+        self.size: int = size
+        self.tempdir = tempfile.TemporaryDirectory(prefix='git-check-pool-')
+        self.cond = threading.Condition()
+        self.slots: List[str] = []
+        self.free: List[str] = []
+        self.created: Set[str] = set()
+        self.checked_out: Dict[str, str] = {}
+
+    def __enter__(self):
+        global _active_pool
+        _active_pool = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _active_pool
+        _active_pool = None
+        for slot in self.created:
+            log(f"{colors.magenta('Remove')} pooled worktree {slot}")
+            with profile.timed(f"worktree remove {slot}", 'worktree'):
+                subprocess.check_call(["git", "worktree", "remove", "--force", slot])
+        self.tempdir.cleanup()
+        return False
+
+    def _take(self, commit: str) -> Optional[str]:
+        # Prefer a slot which is already on the right commit, then the most recently used one
+        for slot in self.free:
+            if self.checked_out[slot] == commit:
+                self.free.remove(slot)
+                return slot
+        if len(self.free) > 0:
+            return self.free.pop()
+        if len(self.slots) < self.size:
+            slot = os.path.join(self.tempdir.name, str(len(self.slots)))
+            self.slots.append(slot)
+            self.checked_out[slot] = ''
+            return slot
+        return None
+
+    @contextmanager
+    def lease(self, commit: str='HEAD'):
+        commit = rev_parse(commit)
+        with self.cond:
+            slot = self._take(commit)
+            while slot is None:
+                self.cond.wait()
+                slot = self._take(commit)
+
+        try:
+            log(f"{colors.magenta('Checking out')} commit {colors.bold(str(commit))} in {slot}")
+            self.checked_out[slot] = ''
+            with profile.timed(f"worktree checkout {commit}", 'worktree'):
+                if slot not in self.created:
+                    subprocess.check_call(["git", "worktree", "add", "-q", "--force", "--detach", slot, commit])
+                    self.created.add(slot)
+                else:
+                    subprocess.check_call(["git", "checkout", "--detach", "--force", "-q", commit], cwd=slot)
+                    subprocess.check_call(["git", "clean", "-ffdxq"], cwd=slot)
+            self.checked_out[slot] = commit
+            yield slot
+        finally:
+            with self.cond:
+                self.free.append(slot)
+                self.cond.notify()
+
+_active_pool: Optional[WorktreePool] = None
+
+def worktree(commit: str='HEAD'):
+    """Lease a worktree from the active pool, or make a temporary one if there is no pool"""
+    if _active_pool is not None:
+        return _active_pool.lease(commit)
+    return TemporaryWorkdir(commit)
+
+def _series(exclude: str, tips: List[str], cwd: str = '.') -> Dict[str, Tuple[str, List[str]]]:
+    """(merge base with `exclude`, commits oldest first) for each of `tips` not contained in `exclude`, from one rev-list"""
+    parents: Dict[str, List[str]] = {}
+    order: Dict[str, int] = {}
+    for line in rev_list(["--parents", "--topo-order"], [f"^{exclude}"] + tips, cwd=cwd):
+        order[line[0]] = len(order)
+        parents[line[0]] = line[1:]
+
+    ret = {}
+    for tip in [tip for tip in tips if tip in parents]:
+        commits: Set[str] = set()
+        boundary: Set[str] = set()
+        stack = [tip]
+        while len(stack) > 0:
+            commit = stack.pop()
+            if commit in commits:
+                continue
+            commits.add(commit)
+            for parent in parents[commit]:
+                if parent in parents:
+                    stack.append(parent)
+                else:
+                    boundary.add(parent)
+        if len(boundary) == 1:
+            base = boundary.pop()
+        else:
+            # Several paths lead back to `exclude` (or none does); let git pick the best one
+            base = subprocess.check_output(["git", "merge-base", exclude, tip], cwd=cwd).decode('ascii').strip()
+        ret[tip] = base, sorted(commits, key=order.__getitem__, reverse=True)
+    return ret
+
+def merge_bases(master: str, tips: List[str], cwd: str = '.') -> Dict[str, Tuple[str, List[str]]]:
+    """
+    Where each of `tips` branched off `master`, and its commits since, oldest first
+
+    For a tip which is not on master yet, that is its merge base with
+    master and the commits on the tip but not on master. A tip which has
+    already been merged is treated as it was just before: `master` is
+    taken back along its first parents to the last commit which does not
+    contain the tip. Each git command walks the history once, however
+    many tips there are (merged tips need one more walk each), and
+    everything is returned as plain ids.
+    """
+    ids = subprocess.check_output(["git", "rev-parse"] + [rev + "^{commit}" for rev in [master] + tips], cwd=cwd).decode('ascii').split()
+    master, resolved = ids[0], dict(zip(tips, ids[1:]))
+    unmerged = _series(master, sorted(set(resolved.values())), cwd=cwd)
+
+    merged = [tip for tip in set(resolved.values()) if tip not in unmerged]
+    before: Dict[str, str] = {} # merged tip -> the first commit along master's first parents without it
+    if len(merged) > 0:
+        # The commits of master's first-parent line which contain a tip are those on its ancestry path, and come first
+        containing = { tip: set(line[0] for line in rev_list(["--ancestry-path"], [f"^{tip}", master], cwd=cwd)) | {tip} for tip in merged }
+        for line in rev_list(["--first-parent"], [master], cwd=cwd):
+            for tip in [tip for tip in containing if line[0] not in containing[tip]]:
+                before[tip] = line[0]
+                del containing[tip]
+            if len(containing) == 0:
+                break
+        if len(containing) > 0:
+            raise ValueError(f"master {master} contains {', '.join(containing)} all the way to its root")
+
+    by_base: Dict[str, List[str]] = {}
+    for tip, base in before.items():
+        by_base.setdefault(base, []).append(tip)
+    for base, group in by_base.items():
+        unmerged.update(_series(base, group, cwd=cwd))
+    return { tip: unmerged[commit] for tip, commit in resolved.items() }
+
+def is_ancestor(commit: str, of: str, cwd: str = '.') -> bool:
+    """Whether `of` contains `commit`"""
+    return subprocess.run(["git", "merge-base", "--is-ancestor", commit, of], cwd=cwd).returncode == 0
+
+def rebase_commit(commit: str, onto: str, cwd: str = '.') -> str:
+    """
+    Cherry-pick `commit` onto `onto` without touching a worktree
+
+    `git merge-tree --write-tree` merges `commit` with a throwaway commit
+    which has the tree of `onto` and `commit`'s parent as its own parent,
+    so the merge base is that parent and the result is what cherry-pick
+    would have produced. The rebased commit keeps the original author and
+    message, and like the cherry-picks before it is committed at the
+    original author date, so rebasing the same commits onto the same base
+    always produces the same ids. Raises CalledProcessError on conflicts.
+    """
+    header, message = cat_file_batch([commit], cwd=cwd)[commit].split(b"\n\n", 1)
+    fields = dict(line.split(b" ", 1) for line in header.split(b"\n") if not line.startswith(b" "))
+    author, author_date = fields[b"author"].decode('utf-8').rsplit("> ", 1)
+    author_name, author_email = author.split(" <", 1)
+
+    def git_output(*args: str, env: Optional[Dict[str, str]] = None, input: Optional[bytes] = None) -> str:
+        return subprocess.check_output(["git"] + list(args), cwd=cwd, env=env, input=input).decode('ascii').split("\n")[0]
+
+    log(f"{colors.magenta('Rebasing')} commit {colors.bold(commit)} onto {colors.bold(onto)}")
+    with profile.timed(f"rebase {commit}", 'rebase'):
+        side = git_output("commit-tree", f"{onto}^{{tree}}", "-p", f"{commit}^", "-m", "rebase")
+        tree = git_output("merge-tree", "--write-tree", "--no-messages", side, commit)
+        env = dict(os.environ,
+                   GIT_AUTHOR_NAME=author_name, GIT_AUTHOR_EMAIL=author_email, GIT_AUTHOR_DATE=author_date,
+                   GIT_COMMITTER_DATE=author_date.split(" ")[0])
+        rebased = git_output("commit-tree", tree, "-p", onto, env=env, input=message)
+    log(f"{colors.magenta('Rebased')} as {colors.bold(rebased)}")
+    return rebased
+
+def ref_tip(ref: str, cwd: str = '.') -> Optional[str]:
+    """Resolve a ref to a commit id, or None if it does not exist"""
+    completed = subprocess.run(["git", "rev-parse", "-q", "--verify", ref], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=cwd)
+    if completed.returncode != 0:
+        return None
+    return completed.stdout.decode('ascii').strip()
+
+def cat_file_batch(objects: Iterable[str], cwd: str = '.') -> Dict[str, bytes]:
+    """
+    Read the contents of many objects with a single `git cat-file --batch`
+
+    Missing objects are left out of the returned map.
+    """
+    objects = list(objects)
+    if len(objects) == 0:
+        return {}
+    request = ("\n".join(objects) + "\n").encode('ascii')
+    output = subprocess.run(["git", "cat-file", "--batch"], input=request, stdout=subprocess.PIPE, check=True, cwd=cwd).stdout
+
+    ret = {}
+    pos = 0
+    for obj in objects:
+        eol = output.index(b"\n", pos)
+        header = output[pos:eol].split(b" ")
+        pos = eol + 1
+        if header[-1] == b"missing":
+            continue
+        size = int(header[2])
+        ret[obj] = output[pos:pos + size]
+        pos += size + 1 # skip trailing newline
+    return ret
+
+def git_common_dir(cwd: str = '.') -> str:
+    """The repository's shared .git directory (the same for all worktrees)"""
+    path = subprocess.check_output(["git", "rev-parse", "--git-common-dir"], cwd=cwd).decode('utf-8').strip()
+    return os.path.join(cwd, path)
+
+def repo_id(cwd: str = '.') -> str:
+    """Names the repository at `cwd`, the same in every worktree or clone of it"""
+    try:
+        repo = subprocess.check_output(["git", "config", "remote.origin.url"], cwd=cwd).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+        repo = os.path.abspath(git_common_dir(cwd))
+    return hashlib.sha256(repo.encode('utf-8')).hexdigest()[:16]
+
+def rev_list(args: List[str], revs: Iterable[str] = (), cwd: str = '.') -> Iterator[List[str]]:
+    """
+    Stream the output of `git rev-list`, one list of ids per line
+
+    `revs` are fed on stdin, so there is no limit on how many tips can be
+    walked in a single traversal.
+    """
+    proc = subprocess.Popen(["git", "rev-list", "--stdin"] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd)
+    assert proc.stdin is not None and proc.stdout is not None
+    proc.stdin.write("".join(rev + "\n" for rev in revs).encode('ascii'))
+    proc.stdin.close()
+    finished = False
+    try:
+        for line in proc.stdout:
+            yield line.decode('ascii').split()
+        finished = True
+    finally:
+        if not finished:
+            proc.kill() # we stopped reading early; do not leave git walking the rest
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
+def commit_parents(commits: Iterable[str], cwd: str = '.') -> Dict[str, List[str]]:
+    """Read the parents of many commits with a single `git cat-file --batch`"""
+    ret = {}
+    for commit, raw in cat_file_batch(commits, cwd=cwd).items():
+        header = raw.split(b"\n\n", 1)[0]
+        ret[commit] = [line[7:].decode('ascii') for line in header.split(b"\n") if line.startswith(b"parent ")]
+    return ret
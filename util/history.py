@@ -0,0 +1,107 @@
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+from util import cache_dir, colors, log
+from util.results import tree_of
+
+# The toolchain at the start of a note line, e.g. 'cargo 1.70.0 (ec8a8a0ca 2023-04-25)'
+TOOLCHAIN = re.compile(r'^(cargo \S+ \([^)]*\)|wasm-pack \S+)')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    commit_id TEXT NOT NULL,
+    tree TEXT NOT NULL,
+    command TEXT NOT NULL,
+    toolchain TEXT,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL,
+    log_path TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_command ON runs (command, started);
+CREATE INDEX IF NOT EXISTS runs_tree ON runs (tree, command);
+CREATE INDEX IF NOT EXISTS runs_commit ON runs (commit_id);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    key TEXT NOT NULL,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, started);
+'''
+
+class History:
+    """
+    Every check we ran, in SQLite: commit, tree, command, toolchain, duration, status and log
+
+    `command` is the note line the check earns, so it names the command
+    and its arguments. A tree which has both passed and failed the same
+    command is reported as flaky as soon as it happens. How long each
+    scheduler job took is kept too, by its key (see util.scheduler.Job),
+    to estimate how long it will take next time.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path: str = path or os.path.join(cache_dir(), 'history.sqlite')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def record(self, commit: str, tree: str, command: str, started: float, duration: float, passed: bool, log_path: Optional[str] = None) -> None:
+        match = TOOLCHAIN.match(command)
+        status = 'passed' if passed else 'failed'
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO runs (started, commit_id, tree, command, toolchain, duration, status, log_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (started, str(commit), tree, command, match.group(1) if match else None, duration, status, log_path))
+            other = self.db.execute("SELECT commit_id FROM runs WHERE tree = ? AND command = ? AND status != ? LIMIT 1", (tree, command, status)).fetchone()
+        if other is not None:
+            log(f"{colors.bold('Flaky')}: {command} has both passed and failed on tree {tree} (commits {other[0]} and {commit})")
+
+    def record_job(self, key: str, started: float, duration: float, passed: bool) -> None:
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO jobs (started, key, duration, status) VALUES (?, ?, ?, ?)", (started, key, duration, 'passed' if passed else 'failed'))
+
+    def job_duration(self, key: str, runs: int = 5) -> Optional[float]:
+        """The mean duration of the last `runs` successful jobs with this key, if there were any"""
+        rows = self.query("SELECT duration FROM jobs WHERE key = ? AND status = 'passed' ORDER BY started DESC LIMIT ?", (key, runs))
+        if len(rows) == 0:
+            return None
+        return sum(row[0] for row in rows) / len(rows)
+
+    def query(self, sql: str, params: Tuple = ()) -> List[Tuple[Any, ...]]:
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def slow(self, since: float, like: str = '%', limit: int = 20) -> List[Tuple[Any, ...]]:
+        """(command, runs, mean, max duration) of the slowest commands since `since`"""
+        return self.query("SELECT command, COUNT(*), AVG(duration), MAX(duration) FROM runs WHERE started >= ? AND command LIKE ? GROUP BY command ORDER BY AVG(duration) DESC LIMIT ?", (since, like, limit))
+
+    def flaky(self, since: float, like: str = '%') -> List[Tuple[Any, ...]]:
+        """(command, tree, passes, failures) for every tree which both passed and failed a command since `since`"""
+        return self.query("SELECT command, tree, SUM(status = 'passed'), SUM(status = 'failed') FROM runs WHERE started >= ? AND command LIKE ? GROUP BY command, tree HAVING COUNT(DISTINCT status) > 1 ORDER BY MAX(started) DESC", (since, like))
+
+    def runs(self, since: float, like: str = '%', commit: Optional[str] = None, limit: int = 50) -> List[Tuple[Any, ...]]:
+        """(started, commit, command, duration, status, log path) of recent runs, newest first"""
+        sql = "SELECT started, commit_id, command, duration, status, log_path FROM runs WHERE started >= ? AND command LIKE ?"
+        params: Tuple = (since, like)
+        if commit is not None:
+            sql += " AND commit_id LIKE ?"
+            params += (commit + '%',)
+        return self.query(sql + " ORDER BY started DESC LIMIT ?", params + (limit,))
+
+# Where check results are recorded, if anywhere (see check.py --no-history)
+history: Optional[History] = None
+
+def record(commit: str, subdir: Optional[str], command: str, started: float, passed: bool, log_path: Optional[str] = None) -> None:
+    """Record a check in `history`, if there is one"""
+    if history is None:
+        return
+    history.record(commit, tree_of(commit, subdir), command, started, time.time() - started, passed, log_path)
@@ -1,30 +1,237 @@
 
-import git # type: ignore
 import os
+import re
+import subprocess
+import threading
+import time
 from time import gmtime, strftime
-from typing import List
+from typing import Dict, List, Optional, Set
+
+import util.history
+import util.results
+from util.git import cat_file_batch, ref_tip, rev_parse
+from util.process import CommandTimedOut
+
+HEX_SHA = re.compile('^[0-9a-f]{40}$')
+# Bracketed annotations which may follow a note line without changing what it records
+ANNOTATIONS = re.compile(r'( \[(took|same build as|cached from|carried from) [^\]]*\])+$')
+
+# What a note line starts with when its command was killed for taking too long (see util.process.Limits)
+TIMED_OUT = 'timed out after '
+
+# Whether update_notes should annotate note lines with how long they took
+note_durations: bool = False
+
+def normalize(line: str) -> str:
+    """A note line without any annotations, for comparison"""
+    return ANNOTATIONS.sub('', line.strip())
+
+def annotate(note: str, seconds: float) -> str:
+    """Add a duration to a note line, if we are doing that"""
+    if note_durations:
+        return note + f" [took {seconds:.1f}s]"
+    return note
+
+def timed_out(notes: List[str]) -> bool:
+    """Whether any of `notes` records a command which timed out"""
+    return any(line.startswith(TIMED_OUT) for line in notes)
+
+def resolve_commit(commit, workdir: Optional[str] = None) -> str:
+    """Turn a commit-ish (GitPython object, sha or name) into a full sha"""
+    commit = str(getattr(commit, 'hexsha', commit))
+    if HEX_SHA.match(commit):
+        return commit
+    return rev_parse(commit, cwd=workdir or '.')
+
+class NotesIndex:
+    """
+    All notes under a single notes ref, held in memory
+
+    Loaded with one `git notes list` and one `git cat-file --batch`, so that
+    asking whether a note line is already present is a dictionary lookup
+    rather than a `git notes show` per question. Notes we write ourselves
+    are added to the index directly; `refresh` reloads it if somebody else
+    moved the ref.
+    """
+    def __init__(self, note_ref: str):
+        self.note_ref: str = note_ref
+        self.lock = threading.Lock()
+        self.tip: Optional[str] = None
+        self.text: Dict[str, str] = {}
+        self.lines: Dict[str, Set[str]] = {}
+        self.load()
+
+    def load(self) -> None:
+        ref = "refs/notes/" + self.note_ref
+        tip = ref_tip(ref)
+        listing = subprocess.check_output(["git", "notes", "--ref", ref, "list"]).decode('ascii')
+
+        blob_of: Dict[str, str] = {}
+        for line in listing.splitlines():
+            blob, commit = line.split()
+            blob_of[commit] = blob
+        blobs = cat_file_batch(set(blob_of.values()))
+
+        text = {}
+        lines = {}
+        for commit, blob in blob_of.items():
+            text[commit] = blobs[blob].decode('utf-8', errors='replace')
+            lines[commit] = set(normalize(l) for l in text[commit].splitlines())
+
+        with self.lock:
+            self.tip, self.text, self.lines = tip, text, lines
+
+    def refresh(self) -> None:
+        if ref_tip("refs/notes/" + self.note_ref) != self.tip:
+            self.load()
+
+    def contains(self, commit: str, line: str) -> bool:
+        with self.lock:
+            return normalize(line) in self.lines.get(commit, ())
+
+    def get(self, commit: str) -> Optional[str]:
+        with self.lock:
+            return self.text.get(commit)
+
+    def set(self, commit: str, text: Optional[str]) -> None:
+        """Replace what we know of `commit`'s note, e.g. with one read in another repository"""
+        with self.lock:
+            if text is None:
+                self.text.pop(commit, None)
+                self.lines.pop(commit, None)
+            else:
+                self.text[commit] = text
+                self.lines[commit] = set(normalize(l) for l in text.splitlines())
+
+    def add(self, commit: str, message: str, tip: Optional[str] = None) -> None:
+        with self.lock:
+            self.text[commit] = append_text(self.text.get(commit), message)
+            self.lines.setdefault(commit, set()).update(normalize(l) for l in message.splitlines())
+            if tip is not None:
+                self.tip = tip
+
+def append_text(existing: Optional[str], message: str) -> str:
+    """The contents `git notes append` would leave behind"""
+    if existing is None:
+        return message + "\n"
+    return existing.rstrip('\n') + "\n\n" + message + "\n"
+
+_indices: Dict[str, NotesIndex] = {}
+_indices_lock = threading.Lock()
+
+def notes_index(note_ref: str = "commits") -> NotesIndex:
+    """Get the (shared, lazily loaded) index for a notes ref"""
+    with _indices_lock:
+        if note_ref not in _indices:
+            _indices[note_ref] = NotesIndex(note_ref)
+        return _indices[note_ref]
 
 def attach_note(message, commit='HEAD', note_ref = "commits"):
-    date = strftime("%Y-%m-%dT%H:%M:%S", gmtime())
+    batch = NotesBatch(note_ref)
+    batch.append(message, commit=commit)
+    batch.flush()
+
+_flush_locks: Dict[str, threading.Lock] = {}
+
+class NotesBatch:
+    """
+    Collects note appends and writes them all as a single notes commit
+
+    Each `git notes append` makes its own notes commit, which is slow and
+    bloats the notes history when labelling hundreds of commits. Instead
+    we merge the new messages with the existing notes (as `append` would)
+    and feed the whole lot to one `git fast-import`.
+    """
+    def __init__(self, note_ref: str = "commits"):
+        self.note_ref: str = note_ref
+        self.lock = threading.Lock()
+        self.pending: Dict[str, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def append(self, message: str, commit='HEAD') -> None:
+        date = strftime("%Y-%m-%dT%H:%M:%S", gmtime())
+        commit = resolve_commit(commit)
+        with self.lock:
+            self.pending.setdefault(commit, []).append(date + "\n" + message)
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if len(pending) == 0:
+            return
+
+        with _flush_locks.setdefault(self.note_ref, threading.Lock()):
+            index = notes_index(self.note_ref)
+            index.refresh()
+            try:
+                self._write(index, pending)
+            except subprocess.CalledProcessError:
+                # Somebody else moved the ref under us; pick up their notes and retry
+                index.load()
+                self._write(index, pending)
 
-    repo = git.Repo()
-    with repo.git.custom_environment(GIT_NOTES_REF="refs/notes/" + note_ref):
-        repo.git.notes("append", "-m", date + "\n" + message, commit)
+    def _write(self, index: NotesIndex, pending: Dict[str, List[str]]) -> None:
+        ref = "refs/notes/" + self.note_ref
+        ident = subprocess.check_output(["git", "var", "GIT_COMMITTER_IDENT"]).strip()
+
+        def data(s: bytes) -> bytes:
+            return b"data %d\n" % len(s) + s + b"\n"
+
+        stream = b"commit " + ref.encode('ascii') + b"\n"
+        stream += b"committer " + ident + b"\n"
+        stream += data(b"Notes added by 'git notes append'\n")
+        if index.tip is not None:
+            stream += b"from " + index.tip.encode('ascii') + b"\n"
+        for commit, messages in pending.items():
+            text = index.get(commit)
+            for message in messages:
+                text = append_text(text, message)
+            stream += b"N inline " + commit.encode('ascii') + b"\n"
+            stream += data(text.encode('utf-8'))
+
+        subprocess.run(["git", "fast-import", "--quiet"], input=stream, check=True)
+        tip = ref_tip(ref)
+        for commit, messages in pending.items():
+            for message in messages:
+                index.add(commit, message)
+        index.tip = tip
 
 def check_is_note(item: str, workdir: str, commit='HEAD', note_ref = "commits"):
-    repo = git.Repo(path=workdir, search_parent_directories=True)
-    with repo.git.custom_environment(GIT_NOTES_REF="refs/notes/" + note_ref):
-        try:
-            notes = repo.git.notes("show", commit)
-        except:
-            notes = ""
-        return item in notes
+    return notes_index(note_ref).contains(resolve_commit(commit, workdir), item)
+
+def update_notes(notes: List[str], new_note: str, command, commit='HEAD', workdir=None, note_ref='commits', subdir: Optional[str] = None):
+    """
+    Run `command` and add `new_note` to `notes`, unless it is already noted
 
-def update_notes(notes: List[str], new_note: str, command, commit='HEAD', workdir=None, note_ref='commits'):
+    If an identical tree (or `subdir` of it) already passed the same
+    command, the note is added, pointing at where the result came from,
+    without running anything. If the command times out, that is noted
+    instead, and the caller carries on with its other commands.
+    """
     if check_is_note(new_note, workdir, commit=commit, note_ref=note_ref):
         print ("# already done", new_note) # Note already inserted
-    else:
-        command()
-        notes += [new_note]
-
+        return
 
+    commit = resolve_commit(commit, workdir)
+    cache = util.results.result_cache
+    origin = cache.get(commit, subdir, new_note) if cache is not None else None
+    if origin is not None:
+        print ("# cached from", origin, new_note)
+        notes += [new_note + f" [cached from {origin}]"]
+    else:
+        start = time.time()
+        try:
+            result = command()
+        except CommandTimedOut as e:
+            util.history.record(commit, subdir, new_note, start, False, e.log_path)
+            notes += [f"{e.reason}: {new_note}"]
+            return
+        except Exception as e:
+            util.history.record(commit, subdir, new_note, start, False, getattr(e, 'log_path', None))
+            raise
+        util.history.record(commit, subdir, new_note, start, True, getattr(result, 'log_path', None) or None)
+        notes += [annotate(new_note, time.time() - start)]
+        if cache is not None:
+            cache.put(commit, subdir, new_note)
@@ -0,0 +1,90 @@
+
+import fcntl
+import json
+import os
+import subprocess
+import threading
+from typing import Dict, Iterable, Optional
+
+from util import cache_dir
+from util.git import repo_id
+
+def patch_ids(commits: Iterable[str], cwd: str = '.') -> Dict[str, str]:
+    """
+    `git patch-id --stable` of many commits, with a single diff-tree and patch-id
+
+    Commits without a diff (empty ones and merges) are left out.
+    """
+    request = "".join(commit + "\n" for commit in commits).encode('ascii')
+    if len(request) == 0:
+        return {}
+    diff = subprocess.Popen(["git", "diff-tree", "--stdin", "-p", "--root"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd)
+    patch_id = subprocess.Popen(["git", "patch-id", "--stable"], stdin=diff.stdout, stdout=subprocess.PIPE, cwd=cwd)
+    assert diff.stdin is not None and diff.stdout is not None
+    diff.stdout.close() # patch-id has it now
+
+    def feed() -> None:
+        assert diff.stdin is not None
+        diff.stdin.write(request)
+        diff.stdin.close()
+    # Fed from a thread, so a long list cannot fill the pipes while nobody reads patch-id's output
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    output, _ = patch_id.communicate()
+    feeder.join()
+    if diff.wait() != 0 or patch_id.returncode != 0:
+        raise subprocess.CalledProcessError(diff.returncode or patch_id.returncode, ["git", "patch-id"])
+
+    ret = {}
+    for line in output.decode('ascii').splitlines():
+        pid, commit = line.split()
+        ret[commit] = pid
+    return ret
+
+class PatchIdIndex:
+    """
+    The patch-id of every commit we have looked at, kept per repository
+
+    A commit's patch-id never changes, so each one is computed once and
+    saved under the cache dir; looking up a rebased stack only diffs the
+    commits we have not seen before. Commits without a patch-id are
+    remembered too, as ''.
+    """
+    def __init__(self, cwd: str = '.', root: Optional[str] = None):
+        self.cwd: str = cwd
+        self.path: str = os.path.join(root or cache_dir('patch-ids'), repo_id(cwd) + '.json')
+        self.ids: Dict[str, str] = {}
+        self.updated: Dict[str, str] = {}
+        try:
+            with open(self.path) as f:
+                self.ids = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def get(self, commits: Iterable[str]) -> Dict[str, str]:
+        """The patch-ids of `commits`, leaving out those without one"""
+        commits = list(commits)
+        missing = [commit for commit in commits if commit not in self.ids]
+        if len(missing) > 0:
+            found = patch_ids(missing, cwd=self.cwd)
+            for commit in missing:
+                self.updated[commit] = self.ids[commit] = found.get(commit, '')
+        return { commit: self.ids[commit] for commit in commits if self.ids[commit] }
+
+    def save(self) -> None:
+        """Merge what we computed into the file, which other runs may have updated meanwhile"""
+        if len(self.updated) == 0:
+            return
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    ids = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                ids = {}
+            ids.update(self.updated)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(ids, f)
+            os.replace(self.path + '.tmp', self.path)
+            self.ids = ids
+            self.updated = {}
@@ -0,0 +1,163 @@
+
+import collections
+import gzip
+import itertools
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from typing import Callable, Deque, Dict, IO, List, Optional
+
+from util import cache_dir, colors, log, profile
+
+# Where command logs go; a fresh directory under the cache dir per run unless set
+log_dir: Optional[str] = None
+# gzip the logs as they are written
+compress_logs: bool = False
+# Commands matching this regex have their output echoed as it arrives
+follow: Optional[str] = None
+# How many lines of output to keep in memory for failure reports
+TAIL_LINES = 100
+
+_log_ids = itertools.count(1)
+_log_dir_lock = threading.Lock()
+
+class CommandFailed(subprocess.CalledProcessError):
+    """A command exited unsuccessfully; carries the last lines of its output and where the rest is"""
+    def __init__(self, returncode: int, cmd: List[str], tail: List[str], log_path: str):
+        super().__init__(returncode, cmd)
+        self.tail: List[str] = tail
+        self.log_path: str = log_path
+
+class CommandTimedOut(CommandFailed):
+    """A command ran for too long, or went too long without any output, and was killed with its process group"""
+    def __init__(self, reason: str, cmd: List[str], tail: List[str], log_path: str):
+        super().__init__(-signal.SIGKILL, cmd, tail, log_path)
+        self.reason: str = reason
+
+    def __str__(self) -> str:
+        return f"Command '{' '.join(self.cmd)}' {self.reason}"
+
+class Limits:
+    """How many seconds a command may run for in all, and without printing anything; None for no limit"""
+    def __init__(self, timeout: Optional[float] = None, stall: Optional[float] = None):
+        self.timeout: Optional[float] = timeout
+        self.stall: Optional[float] = stall
+
+    def __bool__(self) -> bool:
+        return self.timeout is not None or self.stall is not None
+
+class RunResult:
+    def __init__(self, returncode: int, tail: List[str], log_path: str):
+        self.returncode: int = returncode
+        self.tail: List[str] = tail
+        self.log_path: str = log_path
+
+def log_directory() -> str:
+    """The directory logs of this run go in, created on first use"""
+    global log_dir
+    with _log_dir_lock:
+        if log_dir is None:
+            log_dir = cache_dir('logs', time.strftime("%Y-%m-%dT%H-%M-%S", time.gmtime()) + f"-{os.getpid()}")
+        os.makedirs(log_dir, exist_ok=True)
+        return log_dir
+
+def _log_path(cmd: List[str]) -> str:
+    slug = re.sub('[^A-Za-z0-9.=_+-]+', '_', ' '.join(os.path.basename(c) for c in cmd))[:80]
+    path = os.path.join(log_directory(), f"{next(_log_ids):04d}-{slug}.log")
+    if compress_logs:
+        path += '.gz'
+    return path
+
+def _watch(proc: subprocess.Popen, pumps: List[threading.Thread], limits: Limits, start: float, last_output: Callable[[], float]) -> Optional[str]:
+    """Wait for the output of `proc` to end, killing its process group if it exceeds `limits`; returns why it was killed, if it was"""
+    while any(t.is_alive() for t in pumps):
+        next(t for t in pumps if t.is_alive()).join(1)
+        now = time.time()
+        if limits.timeout is not None and now - start > limits.timeout:
+            reason = f"timed out after {limits.timeout:g}s"
+        elif limits.stall is not None and now - last_output() > limits.stall:
+            reason = f"timed out after {limits.stall:g}s without output"
+        else:
+            continue
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass # it exited just now, but may have left children holding the pipes
+        return reason
+    return None
+
+def run_logged(cmd: List[str], cwd: Optional[str] = None, env: Optional[Dict[str, str]] = None, check: bool = True, kind: str = 'command', on_line: Optional[Callable[[str], None]] = None, limits: Limits = Limits()) -> RunResult:
+    """
+    Run a command, streaming its stdout and stderr to a log file
+
+    Only the last TAIL_LINES lines are kept in memory, so memory use does
+    not depend on how chatty the command is. Output is decoded leniently,
+    since compilers are not shy about non-ASCII. Raises CommandFailed on
+    a nonzero exit status if `check` is set. Its wall and CPU time and
+    peak memory are recorded in util.profile under `kind`. If given,
+    `on_line` is also called with every line of stdout.
+
+    A command with `limits` runs in a process group of its own, which is
+    killed if it exceeds them; then CommandTimedOut is raised, whether or
+    not `check` is set.
+    """
+    path = _log_path(cmd)
+    echo = follow is not None and re.search(follow, ' '.join(cmd)) is not None
+    tail: Deque[str] = collections.deque(maxlen=TAIL_LINES)
+    lock = threading.Lock()
+    last_output = time.time()
+
+    logfile: IO[str]
+    if compress_logs:
+        logfile = gzip.open(path, 'wt', encoding='utf-8')
+    else:
+        logfile = open(path, 'w', encoding='utf-8')
+
+    def pump(stream: IO[bytes], prefix: str, on_line: Optional[Callable[[str], None]]) -> None:
+        nonlocal last_output
+        for raw in stream:
+            last_output = time.time()
+            line = prefix + raw.decode('utf-8', errors='replace').rstrip('\n')
+            if on_line is not None:
+                on_line(line)
+            with lock:
+                logfile.write(line + '\n')
+                tail.append(line)
+            if echo:
+                print(f"{colors.magenta('|')} {line}")
+
+    with logfile:
+        logfile.write(f"# {' '.join(cmd)}\n# cwd {cwd or os.getcwd()}\n")
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env, start_new_session=bool(limits))
+        assert proc.stdout is not None and proc.stderr is not None
+        pumps = [threading.Thread(target=pump, args=(proc.stdout, '', on_line)), threading.Thread(target=pump, args=(proc.stderr, 'stderr: ', None))]
+        for t in pumps:
+            t.start()
+        timed_out = _watch(proc, pumps, limits, start, lambda: last_output) if limits else None
+        for t in pumps:
+            t.join()
+        proc.stdout.close()
+        proc.stderr.close()
+        # Reap the child ourselves, to get its own resource usage rather than all our children's
+        _, status, rusage = os.wait4(proc.pid, 0)
+        returncode = proc.returncode = os.waitstatus_to_exitcode(status)
+        profile.add_rusage(' '.join(cmd), kind, start, rusage)
+        logfile.write(f"# exit status {returncode}\n")
+        if timed_out is not None:
+            logfile.write(f"# {timed_out}, killed\n")
+
+    if timed_out is not None:
+        log(f"Command {timed_out}, killed: " + ' '.join(cmd))
+        log(f"Output so far in {path}")
+        raise CommandTimedOut(timed_out, cmd, list(tail), path)
+    if returncode != 0 and check:
+        log("Command failed: " + ' '.join(cmd))
+        for line in tail:
+            print(line)
+        log(f"Full output in {path}")
+        raise CommandFailed(returncode, cmd, list(tail), path)
+    return RunResult(returncode, list(tail), path)
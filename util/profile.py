@@ -0,0 +1,103 @@
+
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from util import colors
+
+class Record:
+    """Wall time, CPU time and peak RSS (KiB) of one command or step"""
+    def __init__(self, name: str, kind: str, start: float, end: float, utime: float = 0.0, stime: float = 0.0, maxrss: int = 0):
+        self.name: str = name
+        self.kind: str = kind
+        self.start: float = start
+        self.end: float = end
+        self.utime: float = utime
+        self.stime: float = stime
+        self.maxrss: int = maxrss
+
+    @property
+    def wall(self) -> float:
+        return self.end - self.start
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'start': self.start,
+            'wall': round(self.wall, 3),
+            'utime': round(self.utime, 3),
+            'stime': round(self.stime, 3),
+            'maxrss_kib': self.maxrss,
+        }
+
+records: List[Record] = []
+_lock = threading.Lock()
+
+def add(record: Record) -> None:
+    with _lock:
+        records.append(record)
+
+def reset() -> None:
+    with _lock:
+        records.clear()
+
+def add_rusage(name: str, kind: str, start: float, rusage: resource.struct_rusage) -> None:
+    """Record a child process, given the rusage `os.wait4` returned for it"""
+    add(Record(name, kind, start, time.time(), rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss))
+
+@contextmanager
+def timed(name: str, kind: str):
+    """Record the wall time of a block of Python code (which forks no children of interest)"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        add(Record(name, kind, start, time.time()))
+
+def critical_path(jobs) -> List[Any]:
+    """
+    The chain of jobs which determined when the last of `jobs` finished
+
+    Walks back from the job which finished last through whichever of its
+    dependencies finished last. Jobs need `start`, `end` and `deps`.
+    """
+    done = [job for job in jobs if job.end is not None]
+    if len(done) == 0:
+        return []
+    path = [max(done, key=lambda job: job.end)]
+    while True:
+        deps = [dep for dep in path[-1].deps if dep.end is not None]
+        if len(deps) == 0:
+            break
+        path.append(max(deps, key=lambda job: job.end))
+    path.reverse()
+    return path
+
+def summary(jobs, top: int = 10) -> None:
+    """Print the slowest commands and the critical path through `jobs`"""
+    with _lock:
+        slowest = sorted(records, key=lambda r: r.wall, reverse=True)[:top]
+    if len(slowest) > 0:
+        print(colors.bold(f"Slowest {len(slowest)} commands:"))
+        for r in slowest:
+            print(f"  {r.wall:8.1f}s wall {r.utime + r.stime:8.1f}s cpu {r.maxrss >> 10:6d} MiB  {r.kind:9} {r.name}")
+
+    path = critical_path(jobs)
+    if len(path) > 0:
+        print(colors.bold(f"Critical path ({path[-1].end - path[0].start:.1f}s):"))
+        for job in path:
+            print(f"  {job.end - job.start:8.1f}s  {job.name}")
+
+def write_report(path: str, jobs) -> None:
+    with _lock:
+        report = {
+            'commands': [r.to_json() for r in records],
+            'jobs': [{ 'name': job.name, 'start': job.start, 'end': job.end } for job in jobs if job.end is not None],
+            'critical_path': [job.name for job in critical_path(jobs)],
+        }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
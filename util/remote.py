@@ -0,0 +1,218 @@
+
+import base64
+import hashlib
+import itertools
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, IO, List, Optional, Set
+
+import util.history
+import util.process
+from util import colors, log
+from util.notes import notes_index
+from util.scheduler import Job, Scheduler, estimate
+
+class RemoteFailed(Exception):
+    """A unit failed on its worker; `notes` are those of its jobs which did finish"""
+    def __init__(self, message: str, notes: List[str]):
+        super().__init__(message)
+        self.notes: List[str] = notes
+
+class Transport:
+    """
+    Carries units of work to workers and their results back
+
+    A unit is a dict with the commit, the JSON of the check, the names of
+    the jobs the check makes for that commit which are to run remotely,
+    the commit's check-commit note (so the worker knows what has already
+    run) and the git remote to fetch the commit from. `run` blocks until
+    some worker has run it.
+    """
+    def run(self, unit: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+class StdioWorker:
+    """A worker process which reads units from its stdin and writes results to its stdout, a JSON line each"""
+    def __init__(self, command: List[str]):
+        self.command = command
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, unit: Dict[str, Any]) -> Dict[str, Any]:
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        try:
+            self.proc.stdin.write((json.dumps(unit) + "\n").encode('utf-8'))
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise RemoteFailed(f"worker {' '.join(self.command)} has exited")
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RemoteFailed(f"worker {' '.join(self.command)} exited with status {self.proc.wait()}")
+        return json.loads(line)
+
+    def close(self) -> None:
+        assert self.proc.stdin is not None
+        self.proc.stdin.close()
+        self.proc.wait()
+
+class CommandTransport(Transport):
+    """
+    Runs units on workers started by commands, one unit per worker at a time
+
+    The scheduler starts no more remote jobs than there are workers (see
+    `workers`), so a unit never waits here and units go out in rank order.
+
+    A command may start the worker anywhere it can fetch from the shared
+    remote, e.g. `ssh builder ./check-worker.py --cores 16`.
+    """
+    def __init__(self, commands: List[List[str]]):
+        self.workers = [StdioWorker(command) for command in commands]
+        self.idle: queue.Queue = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def run(self, unit: Dict[str, Any]) -> Dict[str, Any]:
+        worker = self.idle.get()
+        try:
+            return worker.run(unit)
+        finally:
+            self.idle.put(worker)
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.close()
+
+def local_transport(workers: int, args: List[str] = []) -> CommandTransport:
+    """Stand-in for a cluster: `workers` check-worker.py processes on this machine"""
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'check-worker.py')
+    return CommandTransport([[sys.executable, script] + args for _ in range(workers)])
+
+# The transport checks are shipped over, if any, how many workers it has, and the remote they fetch commits from
+transport: Optional[Transport] = None
+workers: int = 0
+remote: Optional[str] = None
+
+# How much of the end of each log a worker sends back, as all of it goes in one line of JSON
+LOG_BYTES = 1 << 20
+
+_log_ids = itertools.count(1)
+_published: Set[str] = set()
+_published_lock = threading.Lock()
+
+def publish(commit: str) -> None:
+    """Make `commit` fetchable from the shared remote, under refs/git-check/"""
+    assert remote is not None
+    with _published_lock:
+        if commit in _published:
+            return
+        subprocess.check_call(["git", "push", "-q", "--no-verify", remote, f"{commit}:refs/git-check/{commit}"])
+        _published.add(commit)
+
+def unpublish() -> None:
+    """Delete the refs `publish` created"""
+    with _published_lock:
+        if remote is not None and len(_published) > 0:
+            subprocess.call(["git", "push", "-q", "--no-verify", remote] + [f":refs/git-check/{commit}" for commit in _published])
+        _published.clear()
+
+def close() -> None:
+    global transport
+    unpublish()
+    if transport is not None:
+        transport.close()
+        transport = None
+
+def _run_remote(unit: Dict[str, Any]) -> List[str]:
+    assert transport is not None
+    publish(unit['commit'])
+    # As late as possible, so the worker skips whatever has been noted meanwhile
+    unit = dict(unit, notes=notes_index('check-commit').get(unit['commit']))
+    result = transport.run(unit)
+    for name, data in result.get('logs', {}).items():
+        with open(os.path.join(util.process.log_directory(), f"remote-{next(_log_ids):04d}-{name}"), 'wb') as f:
+            f.write(base64.b64decode(data))
+    if 'error' in result:
+        for line in result.get('tail', []):
+            print(line)
+        raise RemoteFailed(f"{', '.join(unit['jobs'])} failed on worker: {result['error']}", result.get('notes', []))
+    return result['notes']
+
+def make_jobs(command, commit: str) -> List[Job]:
+    """
+    The jobs which check `commit`, run on workers if there are any
+
+    All the jobs of the check are shipped as one unit, so that what they
+    share (e.g. a prepass, or autogen.sh) runs once. Jobs which take no
+    cores and depend on nothing only report results we already have, so
+    they stay here. Job keys get a digest of the check's configuration,
+    since its name does not say everything about it. Until a unit has
+    been timed, it is estimated to take as long as its jobs one after
+    another.
+    """
+    jobs = command.make_jobs(commit)
+    config = hashlib.sha256(json.dumps(command.json, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+    for job in jobs:
+        job.key += f" [{config}]"
+    if workers == 0:
+        return jobs
+    ret = [job for job in jobs if job.cores == 0 and len(job.deps) == 0]
+    names = [job.name for job in jobs if job not in ret]
+    if len(names) == 0:
+        return ret
+    unit = { 'commit': commit, 'check': command.json, 'jobs': names, 'remote': remote }
+    shipped = Job(f"{command.TYPE} checks on {commit[:12]} (remote)", lambda _job: _run_remote(unit), cores=0, remote=True)
+    shipped.key += f" [{config}]"
+    history = util.history.history
+    if history is None or history.job_duration(shipped.key) is None:
+        shipped.estimate = sum(estimate(job) for job in jobs if job not in ret)
+    return ret + [shipped]
+
+def run_unit(scheduler: Scheduler, unit: Dict[str, Any], json_object_hook) -> Dict[str, Any]:
+    """Worker side: fetch the commit, then run the check's jobs and return the notes of the named ones which finished"""
+    log_dir = tempfile.mkdtemp(prefix='git-check-worker-logs-')
+    util.process.log_dir = log_dir
+    result: Dict[str, Any] = {}
+    jobs: List[Job] = []
+    try:
+        subprocess.check_call(["git", "fetch", "-q", "--no-tags", unit['remote'], f"refs/git-check/{unit['commit']}"])
+        notes_index('check-commit').set(unit['commit'], unit.get('notes'))
+        command = json.loads(json.dumps(unit['check']), object_hook=json_object_hook)
+        # Every job is submitted, so nothing waits forever on one that is not
+        with scheduler.batch():
+            jobs = [scheduler.submit(job) for job in command.make_jobs(unit['commit'])]
+        for job in jobs:
+            if job.name in unit['jobs']:
+                job.result()
+    except Exception as e:
+        log(f"{colors.bold(', '.join(unit['jobs']))} failed: {e}")
+        result['error'] = str(e)
+        result['tail'] = getattr(e, 'tail', [])
+    finally:
+        scheduler.join()
+        # Even if something failed, what the jobs which finished found, e.g. that a command timed out
+        result['notes'] = [note for job in jobs if job.name in unit['jobs'] and job.done() and not job.failed() for note in job.result()]
+        result['logs'] = {}
+        for name in sorted(os.listdir(log_dir)):
+            with open(os.path.join(log_dir, name), 'rb') as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - LOG_BYTES))
+                data = f.read()
+            if size > LOG_BYTES:
+                data = f"[{size - LOG_BYTES} bytes cut on the worker]\n".encode('utf-8') + data
+            result['logs'][name] = base64.b64encode(data).decode('ascii')
+        shutil.rmtree(log_dir)
+    return result
+
+def serve(scheduler: Scheduler, json_object_hook, input: IO[str], output: IO[str]) -> None:
+    """Worker side: run units from `input` until it is closed, writing results to `output`"""
+    for line in input:
+        output.write(json.dumps(run_unit(scheduler, json.loads(line), json_object_hook)) + "\n")
+        output.flush()
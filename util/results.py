@@ -0,0 +1,63 @@
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+from typing import Dict, Optional, Tuple
+
+from util import cache_dir
+
+# Environment variables which change what a check means, and so belong in its key
+ENV_FLAGS = ('RUSTFLAGS', 'RUSTDOCFLAGS', 'CARGO_BUILD_TARGET', 'CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'LDFLAGS')
+
+_trees: Dict[Tuple[str, Optional[str]], str] = {}
+_trees_lock = threading.Lock()
+
+def tree_of(commit: str, subdir: Optional[str] = None) -> str:
+    """The tree of `commit`, or of `subdir` within it"""
+    with _trees_lock:
+        if (commit, subdir) in _trees:
+            return _trees[(commit, subdir)]
+    rev = f"{commit}:{subdir.strip('/')}" if subdir else f"{commit}^{{tree}}"
+    tree = subprocess.check_output(["git", "rev-parse", rev]).decode('ascii').strip()
+    with _trees_lock:
+        _trees[(commit, subdir)] = tree
+    return tree
+
+class ResultCache:
+    """
+    Successful check results, keyed by content rather than by commit
+
+    A note line already says which command and toolchain version ran; we
+    key it together with the tree (or subtree) it ran on and the
+    environment flags that affect it. A rebased commit with an unchanged
+    tree, or a force-push which only rewords messages, then hits the
+    cache and is noted without being checked again.
+    """
+    def __init__(self, root: Optional[str] = None):
+        self.root: str = root or cache_dir('results')
+
+    def _path(self, tree: str, note: str) -> str:
+        env = ' '.join(f"{var}={os.environ[var]}" for var in ENV_FLAGS if var in os.environ)
+        key = hashlib.sha256(f"{tree}\0{note}\0{env}".encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def get(self, commit: str, subdir: Optional[str], note: str) -> Optional[str]:
+        """The commit whose check produced this result, if we have one"""
+        try:
+            with open(self._path(tree_of(commit, subdir), note)) as f:
+                return json.load(f)['commit']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def put(self, commit: str, subdir: Optional[str], note: str) -> None:
+        path = self._path(tree_of(commit, subdir), note)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({ 'commit': str(commit), 'note': note }, f)
+        os.replace(tmp, path)
+
+# The cache in use, if any (see check.py --no-result-cache)
+result_cache: Optional[ResultCache] = None
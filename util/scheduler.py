@@ -0,0 +1,344 @@
+
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+from concurrent import futures
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import util.history
+from util import colors, log
+from util.git import WorktreePool
+from util.notes import timed_out
+
+# Seconds a job we have never timed is assumed to take, unless it takes no cores here or elsewhere
+DEFAULT_ESTIMATE = 60.0
+
+COMMIT_ID = re.compile(r'\b[0-9a-f]{12,40}\b')
+
+def job_key(name: str) -> str:
+    """A job's name without the commits in it, so the same check on different commits has the same key"""
+    return ' '.join(COMMIT_ID.sub('', name).split())
+
+class DependencyFailed(Exception):
+    pass
+
+class Job:
+    """
+    One unit of work, together with what it costs to run
+
+    `fn` is called with the job itself once every job in `deps` has
+    completed successfully; if `worktree` is a commit, `job.workdir` is a
+    worktree checked out to it for the duration of the call. `cores` and
+    `mem` (in MiB) are what the job is expected to use at its peak, and the
+    job is only started once the scheduler has that much to spare. A
+    `remote` job hands its work to a worker (see util.remote), and is only
+    started once one of the scheduler's workers is free. `key`
+    names what the job does regardless of the commit, so how long it took
+    before can be looked up in util.history.
+    """
+    def __init__(self, name: str, fn: Callable[['Job'], Any], cores: int = 1, mem: int = 0, worktree: Optional[str] = None, deps: List['Job'] = [], remote: bool = False):
+        self.name: str = name
+        self.fn: Callable[['Job'], Any] = fn
+        self.cores: int = cores
+        self.mem: int = mem
+        self.worktree: Optional[str] = worktree
+        self.remote: bool = remote
+        self.deps: List[Job] = list(deps)
+        self.workdir: Optional[str] = None
+        self.key: str = job_key(name)
+        self.estimate: Optional[float] = None
+        self.future: futures.Future = futures.Future()
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+
+    def __str__(self):
+        return self.name
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def failed(self) -> bool:
+        return self.future.done() and (self.future.cancelled() or self.future.exception() is not None)
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        return self.future.result(timeout)
+
+def estimate(job: Job) -> float:
+    """How long `job` should take, going by the history if there is one"""
+    if job.estimate is None:
+        history = util.history.history
+        known = history.job_duration(job.key) if history is not None else None
+        job.estimate = known if known is not None else 0.0 if job.cores == 0 and not job.remote else DEFAULT_ESTIMATE
+    return job.estimate
+
+def ranks(jobs: List[Job]) -> Dict[Job, float]:
+    """
+    Each job's estimate plus the longest chain of estimates depending on it, among `jobs`
+
+    Starting the jobs with the highest rank first starts the critical path
+    first, and otherwise the longest jobs.
+    """
+    dependents: Dict[Job, List[Job]] = {job: [] for job in jobs}
+    for job in jobs:
+        for dep in job.deps:
+            if dep in dependents:
+                dependents[dep].append(job)
+    ret: Dict[Job, float] = {}
+    def rank(job: Job) -> float:
+        if job not in ret:
+            ret[job] = estimate(job) + max((rank(dependent) for dependent in dependents[job]), default=0.0)
+        return ret[job]
+    for job in jobs:
+        rank(job)
+    return ret
+
+def simulate(jobs: List[Job], cores: int, mem: int, worktrees: int, workers: int = 0, now: float = 0.0, running: List[Job] = []) -> List[Tuple[Job, float, float]]:
+    """
+    When each of `jobs` would start and end, if they all took their estimates
+
+    Jobs are started as the scheduler starts them: highest rank first, as
+    soon as their dependencies are done and they fit. `running` jobs
+    started at their `start` and hold their resources until they end.
+    Returns (job, start, end) in the order the jobs would start.
+    """
+    rank = ranks(running + jobs)
+    events: List[Tuple[float, int, Job]] = []
+    ends: Dict[Job, float] = {}
+    order = itertools.count()
+    for job in running:
+        end = max(now, (job.start or now) + estimate(job))
+        heapq.heappush(events, (end, next(order), job))
+        cores -= job.cores
+        mem -= job.mem
+        worktrees -= job.worktree is not None
+        workers -= job.remote
+
+    ret: List[Tuple[Job, float, float]] = []
+    waiting = sorted(jobs, key=rank.__getitem__, reverse=True)
+    t = now
+    while len(waiting) > 0:
+        for job in list(waiting):
+            if any(dep in rank and ends.get(dep, float('inf')) > t for dep in job.deps):
+                continue
+            if job.cores <= cores and job.mem <= mem and (job.worktree is None or worktrees > 0) and (not job.remote or workers > 0):
+                waiting.remove(job)
+                cores -= job.cores
+                mem -= job.mem
+                worktrees -= job.worktree is not None
+                workers -= job.remote
+                heapq.heappush(events, (t + estimate(job), next(order), job))
+                ret.append((job, t, t + estimate(job)))
+        if len(events) == 0:
+            break # what is left can never fit; the scheduler clamps jobs, so this does not happen
+        t, _, job = heapq.heappop(events)
+        ends[job] = t
+        cores += job.cores
+        mem += job.mem
+        worktrees += job.worktree is not None
+        workers += job.remote
+    return ret
+
+def total_mem() -> int:
+    """Physical memory in MiB, or something huge if we cannot tell"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) >> 10
+    except OSError:
+        pass
+    return 1 << 40
+
+class Scheduler:
+    """
+    Runs a DAG of jobs within fixed limits on cores, memory, worktrees and workers
+
+    Jobs are submitted with their dependencies rather than blocking on
+    each other from inside running tasks, so nothing ever waits while
+    holding resources and the pool cannot deadlock. A job which asks for
+    more than the machine limits is clamped to them, so it can still run
+    (on its own). With `fail_fast`, the first job to fail, or to return
+    a note of a command which timed out, cancels every job which has not
+    started yet, and anything submitted after it.
+
+    Of the jobs which are ready, the one with the highest rank (see
+    `ranks`) starts first. As each job finishes, its duration goes into
+    the history and an ETA for the rest is logged.
+    """
+    def __init__(self, cores: Optional[int] = None, mem: Optional[int] = None, worktrees: Optional[int] = None, workers: int = 0, fail_fast: bool = False):
+        self.cores: int = cores or os.cpu_count() or 1
+        self.mem: int = mem or total_mem() * 4 // 5
+        self.worktrees: int = worktrees or self.cores
+        self.workers: int = workers
+        self.fail_fast: bool = fail_fast
+        self.pool = WorktreePool(self.worktrees)
+
+        self.cond = threading.Condition()
+        self.free_cores: int = self.cores
+        self.free_mem: int = self.mem
+        self.free_worktrees: int = self.worktrees
+        self.free_workers: int = self.workers
+        self.pending: List[Job] = []
+        self.running: Set[Job] = set()
+        self.submitted: List[Job] = []
+        self.cancelled: bool = False
+        self.held: int = 0
+        self.thread_ids = itertools.count()
+
+    def __enter__(self):
+        self.pool.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.cancel()
+        self.join()
+        return self.pool.__exit__(exc_type, exc_val, exc_tb)
+
+    def submit(self, job: Job) -> Job:
+        if job.remote and self.workers == 0:
+            raise ValueError(f"{job} needs a worker, and there are none")
+        job.cores = min(job.cores, self.cores)
+        job.mem = min(job.mem, self.mem)
+        estimate(job)
+        with self.cond:
+            self.submitted.append(job)
+            if self.cancelled:
+                job.future.cancel()
+                return job
+            self.pending.append(job)
+            self._dispatch()
+        return job
+
+    @contextmanager
+    def batch(self):
+        """Start nothing until the block ends, so the jobs submitted in it are ranked against each other"""
+        with self.cond:
+            self.held += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.held -= 1
+                self._dispatch()
+
+    def eta(self) -> Optional[float]:
+        """Estimated seconds until every job submitted so far has finished, if any has yet to"""
+        with self.cond:
+            now = time.time()
+            plan = simulate(list(self.pending), self.cores, self.mem, self.worktrees, self.workers, now=now, running=list(self.running))
+            ends = [end for _, _, end in plan] + [max(now, (job.start or now) + estimate(job)) for job in self.running]
+        if len(ends) == 0:
+            return None
+        return max(ends) - now
+
+    def plan(self, jobs: List[Job]) -> List[Tuple[Job, float, float]]:
+        """When `jobs` would start and end, in seconds from now, if they were submitted to this scheduler while idle"""
+        for job in jobs:
+            job.cores = min(job.cores, self.cores)
+            job.mem = min(job.mem, self.mem)
+        return simulate(jobs, self.cores, self.mem, self.worktrees, self.workers)
+
+    def cancel(self) -> None:
+        """Cancel every job which has not started yet, and any submitted later"""
+        with self.cond:
+            self.cancelled = True
+            for job in self.pending:
+                job.future.cancel()
+            self.pending = []
+            self.cond.notify_all()
+
+    def forget_done(self) -> None:
+        """Drop finished jobs from `submitted`, so a long-running scheduler does not keep them all"""
+        with self.cond:
+            self.submitted = [job for job in self.submitted if not job.done()]
+
+    def join(self) -> None:
+        """Wait until every submitted job has finished"""
+        with self.cond:
+            while len(self.pending) > 0 or len(self.running) > 0:
+                self.cond.wait()
+
+    def _dispatch(self) -> None:
+        # Called with self.cond held
+        if self.held > 0:
+            return
+        rank = ranks(self.pending)
+        progress = True
+        while progress:
+            progress = False
+            for job in sorted(self.pending, key=rank.__getitem__, reverse=True):
+                failed = [dep for dep in job.deps if dep.failed()]
+                if len(failed) > 0:
+                    self.pending.remove(job)
+                    job.future.set_exception(DependencyFailed(f"{job} depends on failed job {failed[0]}"))
+                    progress = True # anything depending on this job can now fail too
+                elif all(dep.done() for dep in job.deps) and self._fits(job):
+                    self.pending.remove(job)
+                    self._start(job)
+        self.cond.notify_all()
+
+    def _fits(self, job: Job) -> bool:
+        return job.cores <= self.free_cores and job.mem <= self.free_mem and (job.worktree is None or self.free_worktrees > 0) and (not job.remote or self.free_workers > 0)
+
+    def _start(self, job: Job) -> None:
+        self.free_cores -= job.cores
+        self.free_mem -= job.mem
+        if job.worktree is not None:
+            self.free_worktrees -= 1
+        if job.remote:
+            self.free_workers -= 1
+        self.running.add(job)
+        job.future.set_running_or_notify_cancel()
+        threading.Thread(target=self._run, args=(job,), name=f"git_check_{next(self.thread_ids)}").start()
+
+    def _run(self, job: Job) -> None:
+        job.start = time.time()
+        try:
+            if job.worktree is not None:
+                with self.pool.lease(job.worktree) as workdir:
+                    job.workdir = workdir
+                    result = job.fn(job)
+            else:
+                result = job.fn(job)
+            job.future.set_result(result)
+            # A command which was killed for taking too long is noted rather than raised, but it failed all the same
+            if isinstance(result, list) and timed_out(result):
+                self._failed()
+        except BaseException as e:
+            log(f"{colors.bold(job.name)} failed: {e}")
+            job.future.set_exception(e)
+            self._failed()
+        finally:
+            job.end = time.time()
+            with self.cond:
+                self.free_cores += job.cores
+                self.free_mem += job.mem
+                if job.worktree is not None:
+                    self.free_worktrees += 1
+                if job.remote:
+                    self.free_workers += 1
+                self.running.remove(job)
+                self._dispatch()
+            self._finished(job)
+
+    def _failed(self) -> None:
+        if self.fail_fast and not self.cancelled:
+            log("Cancelling pending jobs")
+            self.cancel()
+
+    def _finished(self, job: Job) -> None:
+        assert job.start is not None and job.end is not None
+        history = util.history.history
+        if history is not None and not job.future.cancelled():
+            history.record_job(job.key, job.start, job.end - job.start, job.future.exception() is None)
+        if job.end - job.start < 1:
+            return # bookkeeping, not worth an ETA line each
+        remaining = self.eta()
+        if remaining is not None:
+            finish = time.strftime("%H:%M:%S", time.localtime(time.time() + remaining))
+            log(f"{colors.magenta('ETA')} {finish}, about {remaining:.0f}s from now ({colors.bold(job.name)} took {job.end - job.start:.0f}s, estimated {estimate(job):.0f}s)")
@@ -0,0 +1,63 @@
+
+import fcntl
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from util import cache_dir
+
+# Assumed for a test we have never timed
+DEFAULT_SECONDS = 0.1
+
+class TestDurations:
+    """
+    How long each test took when it last ran, by test binary and test name
+
+    Kept per repository under the cache dir, so later runs can balance
+    their shards. Test binaries are named without cargo's hash suffix,
+    which changes with every commit.
+    """
+    def __init__(self, repo: str, root: Optional[str] = None):
+        self.path: str = os.path.join(root or cache_dir('test-durations'), repo + '.json')
+        self.lock = threading.Lock()
+        self.seconds: Dict[str, float] = {}
+        self.updated: Dict[str, float] = {}
+        try:
+            with open(self.path) as f:
+                self.seconds = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def get(self, test: str) -> float:
+        return self.seconds.get(test, DEFAULT_SECONDS)
+
+    def record(self, test: str, seconds: float) -> None:
+        with self.lock:
+            self.updated[test] = seconds
+
+    def save(self) -> None:
+        """Merge what we timed into the file, which other runs may have updated meanwhile"""
+        with self.lock, open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    seconds = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                seconds = {}
+            seconds.update(self.updated)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(seconds, f, indent=1, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+            self.seconds = seconds
+            self.updated = {}
+
+def balance(tests: List[str], shards: int, durations: TestDurations) -> List[List[str]]:
+    """Split `tests` into at most `shards` lists of about equal expected duration, longest first"""
+    loads: List[Tuple[float, int]] = [(0.0, i) for i in range(shards)]
+    ret: List[List[str]] = [[] for _ in range(shards)]
+    for test in sorted(tests, key=durations.get, reverse=True):
+        load, i = min(loads)
+        ret[i].append(test)
+        loads[i] = (load + durations.get(test), i)
+    return [shard for shard in ret if len(shard) > 0]
@@ -0,0 +1,84 @@
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+from typing import Dict, Tuple
+
+from util import cache_dir
+
+# Version strings we have already resolved in this run, by tool and toolchain
+_versions: Dict[str, str] = {}
+_lock = threading.Lock()
+
+def _cache_file() -> str:
+    return os.path.join(cache_dir(), 'toolchains.json')
+
+def _rustup_stamp(toolchain: str) -> str:
+    """Something which changes whenever rustup installs, updates or removes a toolchain"""
+    rustup_home = os.environ.get('RUSTUP_HOME') or os.path.join(os.path.expanduser('~'), '.rustup')
+    toolchains = os.path.join(rustup_home, 'toolchains')
+    try:
+        stamp = [os.stat(toolchains).st_mtime_ns]
+        for entry in os.listdir(toolchains):
+            if entry == toolchain or entry.startswith(toolchain + '-'):
+                stamp.append(os.stat(os.path.join(toolchains, entry)).st_mtime_ns)
+    except FileNotFoundError:
+        return ''
+    return ' '.join(str(x) for x in stamp)
+
+def _wasm_pack_stamp() -> str:
+    path = shutil.which('wasm-pack')
+    if path is None:
+        return ''
+    return f"{path} {os.stat(path).st_mtime_ns}"
+
+def _resolve(key: str, stamp: str, probe) -> str:
+    with _lock:
+        if key in _versions:
+            return _versions[key]
+
+        try:
+            with open(_cache_file()) as f:
+                on_disk = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            on_disk = {}
+
+        entry = on_disk.get(key)
+        if stamp != '' and entry is not None and entry['stamp'] == stamp:
+            version = entry['version']
+        else:
+            version = probe()
+            on_disk[key] = { 'stamp': stamp, 'version': version }
+            with open(_cache_file() + '.tmp', 'w') as f:
+                json.dump(on_disk, f, indent=1)
+            os.replace(_cache_file() + '.tmp', _cache_file())
+
+        _versions[key] = version
+        return version
+
+def forget() -> None:
+    """Check stamps again on next use, so a long-running process notices toolchain updates"""
+    with _lock:
+        _versions.clear()
+
+def rust_version(toolchain: str) -> str:
+    """The `cargo -V` string of a rustup toolchain, e.g. 'cargo 1.70.0 (ec8a8a0ca 2023-04-25)'"""
+    def probe() -> str:
+        return subprocess.check_output(["cargo", "+" + toolchain, "-V"]).decode('ascii').strip()
+    return _resolve('cargo +' + toolchain, _rustup_stamp(toolchain), probe)
+
+def rust_release(version: str) -> Tuple[int, int]:
+    """The major and minor version of a `rust_version` string, e.g. (1, 70)"""
+    match = re.search(r'(\d+)\.(\d+)', version)
+    if match is None:
+        raise ValueError(f"no version number in {version!r}")
+    return int(match.group(1)), int(match.group(2))
+
+def wasm_pack_version() -> str:
+    """The `wasm-pack --version` string"""
+    def probe() -> str:
+        return subprocess.check_output(["wasm-pack", "--version"]).decode('ascii').strip()
+    return _resolve('wasm-pack', _wasm_pack_stamp(), probe)